@@ -1,31 +1,48 @@
 # bot.py
 import os
 import asyncio
+import collections
+import contextvars
 import sqlite3
 import asyncpg # ❗ Драйвер для Neon/PostgreSQL
+import contextlib
 import csv
-import io
+import gzip
+import json
+import multiprocessing
+import signal
+import socket
+import tempfile
+import zipfile
 import logging 
 import html    
 import re
+import time
+from array import array
+from datetime import datetime, timedelta
 from typing import Optional
 
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import Bot, Dispatcher, BaseMiddleware, types, F
 from aiogram.filters import Command
 from aiogram.types import (
     Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove,
-    InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+    InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, FSInputFile, Update
 )
+from aiogram.methods import TelegramMethod
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage 
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 
 # ❗ НОВІ ІМПОРТИ ДЛЯ ВЕБХУКА
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiohttp import web
 
 from aiohttp.client_exceptions import ClientConnectorError
-from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter, TelegramNetworkError, TelegramServerError
+)
 
 from dotenv import load_dotenv
 
@@ -35,8 +52,11 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # --- Налаштування Бота ---
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-ARCHIVE_CHANNEL_ID = os.getenv("ARCHIVE_CHANNEL_ID") 
+# Числовий ID каналу (-100...): зберігається в broadcast_jobs.from_chat_id (BIGINT), тому одразу int
+ARCHIVE_CHANNEL_ID = int(os.getenv("ARCHIVE_CHANNEL_ID")) if os.getenv("ARCHIVE_CHANNEL_ID") else None
 DATABASE_URL = os.getenv("DATABASE_URL") 
+# Пряме (не через pgbouncer) підключення для LISTEN; якщо не задано — слухаємо через з'єднання з пулу
+DATABASE_LISTEN_URL = os.getenv("DATABASE_LISTEN_URL")
 ADMINS = [
     7996371062,      # Я
     798102209,      # Галя
@@ -58,17 +78,384 @@ WEB_SERVER_PORT = int(os.getenv("PORT", 8080)) # Render надає порт у 
 
 WEBHOOK_PATH = f"/webhook/{BOT_TOKEN}"
 WEBHOOK_URL = f"{BASE_WEBHOOK_URL}{WEBHOOK_PATH}"
+# Відповідь у тілі вебхука: простий хендлер повертає один метод Bot API замість окремого HTTP-запиту.
+# Вимагає обробки апдейту в межах запиту від Telegram (без фонової обробки), тому вмикається явно.
+WEBHOOK_REPLY_MODE = os.getenv("WEBHOOK_REPLY_MODE", "0").lower() in ("1", "true", "yes")
+
+# --- Налаштування швидкості розсилки ---
+# Bot API дозволяє ~30 повідомлень/с загалом і ~1 повідомлення/с в один чат.
+OUTBOUND_RATE = float(os.getenv("OUTBOUND_RATE", 28))                     # спільний ліміт усіх вихідних повідомлень, /с
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))                   # ліміт розсилок (bulk) у межах OUTBOUND_RATE, /с
+BROADCAST_PER_CHAT_RATE = float(os.getenv("BROADCAST_PER_CHAT_RATE", 1))  # ліміт на один чат, повідомлень/с
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 20))       # кількість одночасних відправок
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", 3))        # повтори після TelegramRetryAfter
+RECIPIENT_PAGE_SIZE = int(os.getenv("RECIPIENT_PAGE_SIZE", 1000))         # отримувачів на одну сторінку з БД
+ADMIN_NOTIFY_MAX_RETRIES = int(os.getenv("ADMIN_NOTIFY_MAX_RETRIES", 3))  # повтори сповіщень адмінам при тимчасових збоях
+
+# --- Налаштування кешу ---
+# Зміни з інших інстансів приходять через LISTEN/NOTIFY; TTL обмежує застарілість, якщо сповіщення загубилось
+FOLDERS_CACHE_TTL = float(os.getenv("FOLDERS_CACHE_TTL", 600))  # секунд; папки змінюються рідко
+REPLY_MAP_CACHE_SIZE = int(os.getenv("REPLY_MAP_CACHE_SIZE", 10000))  # повідомлень адмінам -> user_id у пам'яті
+REPLY_MAP_RETENTION_DAYS = int(os.getenv("REPLY_MAP_RETENTION_DAYS", 180))  # скільки днів зберігати зв'язки в БД
+POSTS_CACHE_TTL = float(os.getenv("POSTS_CACHE_TTL", 300))      # секунд; сторінки постів у папках
+FOLDER_PAGE_SIZE = int(os.getenv("FOLDER_PAGE_SIZE", 10))       # постів на одній сторінці папки
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", 10))         # записів на сторінці адмін-списків (/check_db, /find_user, /check_tickets)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 5000))       # профілів користувачів у кеші
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 300))        # секунд
+
+# --- Налаштування фонових задач ---
+BACKGROUND_MAX_RUNNING = int(os.getenv("BACKGROUND_MAX_RUNNING", 2))               # одночасно виконуваних задач
+BACKGROUND_MAX_QUEUED = int(os.getenv("BACKGROUND_MAX_QUEUED", 20))                # задач, що чекають у черзі
+BACKGROUND_SHUTDOWN_TIMEOUT = float(os.getenv("BACKGROUND_SHUTDOWN_TIMEOUT", 20))  # секунд на завершення при зупинці
+
+# --- Налаштування черги вхідних апдейтів ---
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 8))                      # одночасно оброблюваних апдейтів
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", 500))              # апдейтів, що чекають у черзі
+INGEST_SHUTDOWN_TIMEOUT = float(os.getenv("INGEST_SHUTDOWN_TIMEOUT", 10)) # секунд на дообробку черги при зупинці
+
+# --- Налаштування дедуплікації апдейтів ---
+DEDUP_WINDOW = int(os.getenv("DEDUP_WINDOW", 65536))                   # останніх update_id у пам'яті (1 біт на кожен)
+DEDUP_RETENTION_HOURS = int(os.getenv("DEDUP_RETENTION_HOURS", 48))    # скільки годин пам'ятати оброблені апдейти в БД
+
+# --- Налаштування антифлуду (вхідні повідомлення від користувачів) ---
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", 0.5))                        # повідомлень/с, що проходять стабільно
+FLOOD_BURST = int(os.getenv("FLOOD_BURST", 5))                          # скільки повідомлень поспіль проходить одразу
+FLOOD_COALESCE_WINDOW = float(os.getenv("FLOOD_COALESCE_WINDOW", 15))   # секунд збору надлишкових повідомлень у пачку
+FLOOD_MAX_BUNDLE = int(os.getenv("FLOOD_MAX_BUNDLE", 30))               # повідомлень у пачці; решта відкидається
+
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # якщо задано, /metrics доступний лише з ?token=...
+
+# --- Налаштування кількох воркерів ---
+# При WEB_CONCURRENCY > 1 супервізор запускає стільки процесів, і всі слухають один порт (SO_REUSEPORT).
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", 1)))
+# Один воркер: стан FSM у пам'яті (без запиту в БД на кожне оновлення). Кілька — лише спільний 'postgres'.
+FSM_STORAGE = os.getenv("FSM_STORAGE", "postgres" if WEB_CONCURRENCY > 1 else "memory").lower()  # 'postgres' (спільне, переживає рестарт) або 'memory'
+FSM_STATE_TTL_HOURS = float(os.getenv("FSM_STATE_TTL_HOURS", 24))           # через скільки годин без змін стан FSM застарілий
+BROADCAST_LEASE_SECONDS = float(os.getenv("BROADCAST_LEASE_SECONDS", 60))   # розсилку без heartbeat довше за це підхоплює інший воркер
+WORKER_INDEX = 0           # номер воркера; у дочірніх процесах задає супервізор
+WORKER_RESPAWNED = False   # True, якщо супервізор перезапустив воркер після падіння
+
+
+# --- СХОВИЩЕ СТАНІВ FSM (Postgres) ---
+
+class PostgresStorage(BaseStorage):
+    """
+    Стани і дані FSM у таблиці fsm_storage: їх бачать усі воркери, і розпочатий /broadcast
+    переживає рестарт процесу. Записи без змін довше за ttl вважаються застарілими й видаляються (prune).
+    """
+
+    def __init__(self, ttl_hours: float):
+        self.ttl_seconds = ttl_hours * 3600
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        business_connection_id = getattr(key, 'business_connection_id', None) or ''
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{business_connection_id}:{key.destiny}"
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        async with pool.acquire() as conn:
+            await conn.execute(
+                """
+                INSERT INTO fsm_storage (key, state) VALUES ($1, $2)
+                ON CONFLICT (key) DO UPDATE SET state = EXCLUDED.state, updated_at = CURRENT_TIMESTAMP
+                """,
+                self._key(key), value
+            )
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        async with pool.acquire() as conn:
+            return await conn.fetchval(
+                "SELECT state FROM fsm_storage WHERE key = $1 AND updated_at > NOW() - make_interval(secs => $2)",
+                self._key(key), self.ttl_seconds
+            )
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        async with pool.acquire() as conn:
+            await conn.execute(
+                """
+                INSERT INTO fsm_storage (key, data) VALUES ($1, $2::jsonb)
+                ON CONFLICT (key) DO UPDATE SET data = EXCLUDED.data, updated_at = CURRENT_TIMESTAMP
+                """,
+                self._key(key), json.dumps(dict(data))
+            )
+
+    async def get_data(self, key: StorageKey) -> dict:
+        async with pool.acquire() as conn:
+            raw = await conn.fetchval(
+                "SELECT data FROM fsm_storage WHERE key = $1 AND updated_at > NOW() - make_interval(secs => $2)",
+                self._key(key), self.ttl_seconds
+            )
+        return json.loads(raw) if raw else {}
+
+    async def prune(self) -> int:
+        """Видаляє застарілі та порожні (після state.clear()) записи."""
+        async with pool.acquire() as conn:
+            result = await conn.execute(
+                """
+                DELETE FROM fsm_storage
+                WHERE updated_at < NOW() - make_interval(secs => $1)
+                   OR (state IS NULL AND data = '{}'::jsonb)
+                """,
+                self.ttl_seconds
+            )
+        return int(result.split()[-1])
 
-storage = MemoryStorage()
+    async def close(self) -> None:
+        # З'єднання належать глобальному пулу, його закриває on_shutdown
+        pass
+
+
+storage = PostgresStorage(FSM_STATE_TTL_HOURS) if FSM_STORAGE == "postgres" else MemoryStorage()
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher(storage=storage) 
 
 pool: asyncpg.Pool = None
+TRGM_AVAILABLE = False  # чи встановлено розширення pg_trgm (визначається в init_db)
 
 class BroadcastStates(StatesGroup):
     waiting_for_content = State()
     waiting_for_folder = State()
 
+class ImportStates(StatesGroup):
+    waiting_for_file = State()
+
+# --- КЕШ У ПАМ'ЯТІ ---
+
+_MISSING = object()
+
+class TTLCache:
+    """
+    Невеликий LRU-кеш з часом життя записів.
+    generation збільшується при кожній інвалідації: значення, прочитане з БД до інвалідації,
+    не потрапить у кеш після неї (set з застарілим generation ігнорується).
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation = 0
+        self._data = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key, _MISSING)
+        if item is _MISSING:
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, generation: Optional[int] = None):
+        if generation is not None and generation != self.generation:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self.generation += 1
+        self._data.pop(key, None)
+
+    def clear(self):
+        self.generation += 1
+        self._data.clear()
+
+
+# Список папок і готові клавіатури меню (по одній на кожен префікс callback_data)
+folders_cache = TTLCache(maxsize=16, ttl=FOLDERS_CACHE_TTL)
+
+def invalidate_folders_cache(publish: bool = True):
+    folders_cache.clear()
+    if publish:
+        cache_bus.publish("folders")
+
+
+# Сторінки постів: folder_id -> {(напрямок, курсор): сторінка}
+posts_cache = TTLCache(maxsize=256, ttl=POSTS_CACHE_TTL)
+
+def invalidate_posts_cache(folder_id: int, publish: bool = True):
+    posts_cache.pop(folder_id)
+    if publish:
+        cache_bus.publish(f"posts:{folder_id}")
+
+
+# Профілі користувачів (рядок users) для гарячого шляху вхідних повідомлень
+user_profile_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+# Повідомлення в чатах адмінів -> user_id автора: (admin_chat_id, message_id) -> user_id.
+# Зв'язок ніколи не змінюється, тому кеш не інвалідовується — лише витісняється за LRU/TTL.
+reply_target_cache = TTLCache(maxsize=REPLY_MAP_CACHE_SIZE, ttl=24 * 3600)
+
+def invalidate_user_cache(user_ids=None, publish: bool = True):
+    """Скидає кеш профілів для переданих user_id (або весь кеш, якщо None)."""
+    if user_ids is None:
+        user_profile_cache.clear()
+    else:
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+        for user_id in user_ids:
+            user_profile_cache.pop(user_id)
+    if publish:
+        cache_bus.publish_users(user_ids)
+
+
+# --- МЕТРИКИ ---
+# Лічильники (metrics['назва'] += 1) і гейджі (функції без аргументів) для ендпоінта /metrics.
+metrics = collections.Counter()
+metric_gauges = {}
+
+def render_metrics() -> str:
+    lines = [f"{name} {round(value, 1) if isinstance(value, float) else value}" for name, value in sorted(metrics.items())]
+    lines += [f"{name} {read()}" for name, read in sorted(metric_gauges.items())]
+    return "\n".join(lines) + "\n"
+
+
+# --- ІНВАЛІДАЦІЯ КЕШІВ МІЖ ІНСТАНСАМИ (LISTEN/NOTIFY) ---
+
+CACHE_CHANNEL = "cache_invalidation"
+CACHE_NOTIFY_MAX_USER_IDS = 500  # більше id в одному повідомленні — скидаємо весь кеш профілів (ліміт payload 8000 байт)
+
+class CacheInvalidationBus:
+    """
+    Після запису в БД інстанс надсилає pg_notify з тим, що треба скинути ("folders", "posts:<id>",
+    "users" або "users:<id>,<id>"), а кожен інстанс тримає окреме з'єднання з LISTEN і скидає ці ключі у себе.
+    Якщо з'єднання обірвалось, сповіщення могли загубитись — тому після перепідключення кеші скидаються повністю.
+    """
+
+    def __init__(self, channel: str):
+        self.channel = channel
+        self._pending = set()
+        self._flush_task = None
+        self._conn = None
+        self._connection_lost = asyncio.Event()
+        self._watch_task = None
+
+    # --- відправка ---
+
+    def publish(self, scope: str):
+        """Ставить сповіщення в чергу; усі, що накопичились за один прохід циклу подій, йдуть одним запитом."""
+        if pool is None:
+            return
+        self._pending.add(scope)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush())
+
+    def publish_users(self, user_ids: Optional[list]):
+        if user_ids is None or len(user_ids) > CACHE_NOTIFY_MAX_USER_IDS:
+            self.publish("users")
+        else:
+            self.publish("users:" + ",".join(str(user_id) for user_id in user_ids))
+
+    async def _flush(self, attempts: int = 3):
+        # Усе, що додано в _pending під час await нижче, відправляється наступним проходом того ж циклу
+        failures = 0
+        await asyncio.sleep(0)
+        while self._pending:
+            payloads, self._pending = self._pending, set()
+            try:
+                async with pool.acquire() as conn:
+                    await conn.execute(
+                        "SELECT pg_notify($1, $2 || '|' || scope) FROM unnest($3::TEXT[]) AS scope",
+                        self.channel, worker_id(), sorted(payloads)
+                    )
+                metrics['cache_invalidations_sent'] += len(payloads)
+                failures = 0
+            except Exception as e:
+                failures += 1
+                if failures >= attempts:
+                    # Інші інстанси побачать зміни після TTL
+                    logging.error(f"Не вдалося надіслати інвалідацію кешу {sorted(payloads)}: {e}")
+                    metrics['cache_invalidations_failed'] += len(payloads)
+                    failures = 0
+                    continue
+                self._pending |= payloads
+                await asyncio.sleep(failures)
+
+    # --- прийом ---
+
+    def _on_notify(self, connection, pid, channel, payload: str):
+        origin, _, scope = payload.partition('|')
+        if origin == worker_id():
+            return  # власні зміни вже скинуто локально
+        metrics['cache_invalidations_received'] += 1
+        name, _, keys = scope.partition(':')
+        if name == 'folders':
+            invalidate_folders_cache(publish=False)
+        elif name == 'posts' and keys:
+            invalidate_posts_cache(int(keys), publish=False)
+        elif name == 'users':
+            invalidate_user_cache([int(user_id) for user_id in keys.split(',')] if keys else None, publish=False)
+
+    def _on_connection_lost(self, connection):
+        self._connection_lost.set()
+
+    async def _connect(self):
+        if DATABASE_LISTEN_URL:
+            self._conn = await asyncpg.connect(DATABASE_LISTEN_URL)
+        else:
+            self._conn = await pool.acquire()
+        self._conn.add_termination_listener(self._on_connection_lost)
+        await self._conn.add_listener(self.channel, self._on_notify)
+        self._connection_lost.clear()
+
+    async def _disconnect(self):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        try:
+            await conn.remove_listener(self.channel, self._on_notify)
+        except Exception:
+            pass
+        conn.remove_termination_listener(self._on_connection_lost)
+        if DATABASE_LISTEN_URL:
+            await conn.close()
+        else:
+            await pool.release(conn)
+
+    async def _watch(self):
+        """Перепідключає LISTEN після обриву з'єднання."""
+        while True:
+            await self._connection_lost.wait()
+            logging.warning("З'єднання LISTEN для інвалідації кешів обірвалось, перепідключаюсь.")
+            await self._disconnect()
+            while self._conn is None:
+                try:
+                    await self._connect()
+                except Exception as e:
+                    logging.error(f"Не вдалося відновити LISTEN {self.channel}: {e}")
+                    await asyncio.sleep(5)
+            # Поки з'єднання не було, сповіщення могли загубитись
+            invalidate_folders_cache(publish=False)
+            posts_cache.clear()
+            invalidate_user_cache(publish=False)
+
+    async def start(self):
+        try:
+            await self._connect()
+        except Exception as e:
+            # Бот працює і без шини (кеші оновляться за TTL), а _watch продовжить спроби підключення
+            logging.error(f"Не вдалося підключити LISTEN {self.channel}: {e}")
+            self._connection_lost.set()
+        self._watch_task = asyncio.create_task(self._watch())
+        logging.info(f"📡 Слухаю інвалідації кешів ({self.channel}).")
+
+    async def stop(self):
+        if self._watch_task:
+            self._watch_task.cancel()
+            await asyncio.gather(self._watch_task, return_exceptions=True)
+        if self._flush_task:
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self._disconnect()
+
+
+cache_bus = CacheInvalidationBus(CACHE_CHANNEL)
+
+
 # --- ❗❗❗ НОВІ ФУНКЦІЇ РОБОТИ З БАЗОЮ (asyncpg) ❗❗❗ ---
 
 async def init_db():
@@ -81,17 +468,72 @@ async def init_db():
                 username TEXT,
                 full_name TEXT,
                 phone_number TEXT,
-                tags TEXT DEFAULT '' -- 💡 ПЕРЕКОНАЙТЕСЯ, ЩО ЦЕЙ РЯДОК ДОДАНО
+                tags TEXT[] NOT NULL DEFAULT '{}' -- 💡 ПЕРЕКОНАЙТЕСЯ, ЩО ЦЕЙ РЯДОК ДОДАНО
             )
         """)
 
         await conn.execute("""
             DO $$ BEGIN
                 IF NOT EXISTS (SELECT 1 FROM pg_attribute WHERE attrelid = 'users'::regclass AND attname = 'tags') THEN
-                    ALTER TABLE users ADD COLUMN tags TEXT DEFAULT '';
+                    ALTER TABLE users ADD COLUMN tags TEXT[] NOT NULL DEFAULT '{}';
+                END IF;
+            END $$;
+        """)
+
+        # Міграція міток: рядок 'a,b,c' -> масив TEXT[] (один раз, для старих баз)
+        await conn.execute("""
+            DO $$ BEGIN
+                IF (SELECT data_type FROM information_schema.columns
+                    WHERE table_schema = current_schema() AND table_name = 'users' AND column_name = 'tags') = 'text' THEN
+                    ALTER TABLE users ALTER COLUMN tags DROP DEFAULT;
+                    ALTER TABLE users ALTER COLUMN tags TYPE TEXT[]
+                        USING array_remove(regexp_split_to_array(btrim(COALESCE(tags, ''), ' ,'), ' *, *'), '');
+                    UPDATE users SET tags = '{}' WHERE tags IS NULL;
+                    ALTER TABLE users ALTER COLUMN tags SET DEFAULT '{}', ALTER COLUMN tags SET NOT NULL;
                 END IF;
             END $$;
         """)
+        # Пошук усіх користувачів з міткою (tags @> ARRAY['...']) — через GIN-індекс
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_tags ON users USING gin (tags)")
+
+        # Стан доставки: 'active', 'blocked' (заблокував бота) або 'deactivated' (акаунт видалено).
+        # Неактивні користувачі не потрапляють у розсилки.
+        await conn.execute("""
+            ALTER TABLE users
+                ADD COLUMN IF NOT EXISTS status TEXT NOT NULL DEFAULT 'active',
+                ADD COLUMN IF NOT EXISTS blocked_at TIMESTAMP
+        """)
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_users_inactive ON users (user_id) WHERE status <> 'active'
+        """)
+
+        # Дата першого /start — для сегментів joined>... (для старих записів невідома, лишається NULL)
+        await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS joined_at TIMESTAMP")
+        await conn.execute("ALTER TABLE users ALTER COLUMN joined_at SET DEFAULT NOW()")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_joined_at ON users (joined_at)")
+
+        # Нормалізований ключ телефону: останні 9 цифр (без +, пробілів, коду країни).
+        # Заповнюється в add_user; тут — міграція для старих записів.
+        await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS phone_key TEXT")
+        await conn.execute("""
+            UPDATE users
+            SET phone_key = NULLIF(RIGHT(regexp_replace(phone_number, '[^0-9]', '', 'g'), 9), '')
+            WHERE phone_number IS NOT NULL AND phone_key IS NULL
+        """)
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_phone_key ON users (phone_key)")
+
+        # Нечіткий пошук (/find_user, фільтри розсилки): триграмні GIN-індекси для ILIKE '%...%'
+        global TRGM_AVAILABLE
+        try:
+            await conn.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            for column in ('full_name', 'username', 'phone_number'):
+                await conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS idx_users_{column}_trgm ON users USING gin ({column} gin_trgm_ops)"
+                )
+            TRGM_AVAILABLE = True
+        except asyncpg.exceptions.PostgresError as e:
+            TRGM_AVAILABLE = False
+            logging.warning(f"pg_trgm недоступний, пошук працюватиме без індексу і ранжування: {e}")
 
         await conn.execute("""
             CREATE TABLE IF NOT EXISTS folders (
@@ -109,6 +551,9 @@ async def init_db():
                 FOREIGN KEY (folder_id) REFERENCES folders(id) ON DELETE CASCADE
             )
         """)
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_posts_folder_created ON posts (folder_id, created_at, id)
+        """)
         await conn.execute("""
             CREATE TABLE IF NOT EXISTS support_tickets (
                 id SERIAL PRIMARY KEY,
@@ -121,8 +566,153 @@ async def init_db():
                 closed_by_admin_id BIGINT
             )
         """)
+        # message_text тікета — останнє повідомлення (для прев'ю), повна історія — у support_ticket_messages
+        await conn.execute("""
+            ALTER TABLE support_tickets
+                ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP,
+                ADD COLUMN IF NOT EXISTS message_count INTEGER NOT NULL DEFAULT 1
+        """)
+        # Один відкритий тікет на користувача. Перший запуск: переносимо тексти старих тікетів у дочірню таблицю
+        # і зливаємо кілька відкритих тікетів одного користувача в найновіший, інакше унікальний індекс не створиться.
+        if not await conn.fetchval("SELECT to_regclass('support_ticket_messages') IS NOT NULL"):
+            async with conn.transaction():
+                await conn.execute("""
+                    CREATE TABLE support_ticket_messages (
+                        id BIGSERIAL PRIMARY KEY,
+                        ticket_id INTEGER NOT NULL REFERENCES support_tickets(id) ON DELETE CASCADE,
+                        message_text TEXT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
+                await conn.execute("""
+                    WITH keep AS (
+                        SELECT DISTINCT ON (user_id) user_id, id FROM support_tickets
+                        WHERE status = 'open'
+                        ORDER BY user_id, created_at DESC, id DESC
+                    )
+                    INSERT INTO support_ticket_messages (ticket_id, message_text, created_at)
+                    SELECT COALESCE(keep.id, t.id), t.message_text, t.created_at
+                    FROM support_tickets t
+                    LEFT JOIN keep ON t.status = 'open' AND keep.user_id = t.user_id
+                    ORDER BY t.created_at, t.id
+                """)
+                await conn.execute("""
+                    DELETE FROM support_tickets t
+                    WHERE t.status = 'open' AND EXISTS (
+                        SELECT 1 FROM support_tickets newer
+                        WHERE newer.user_id = t.user_id AND newer.status = 'open'
+                          AND (newer.created_at, newer.id) > (t.created_at, t.id)
+                    )
+                """)
+                await conn.execute("""
+                    UPDATE support_tickets t
+                    SET message_count = m.message_count, updated_at = m.last_at
+                    FROM (
+                        SELECT ticket_id, COUNT(*) AS message_count, MAX(created_at) AS last_at
+                        FROM support_ticket_messages GROUP BY ticket_id
+                    ) m
+                    WHERE m.ticket_id = t.id
+                """)
+                logging.info("Тікети переведено на ланцюжки повідомлень (support_ticket_messages).")
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_support_ticket_messages_ticket ON support_ticket_messages (ticket_id, id)
+        """)
+        await conn.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS uq_support_tickets_open_user ON support_tickets (user_id) WHERE status = 'open'
+        """)
+        # Які повідомлення в чатах адмінів належать якому користувачу (для відповідей через Reply)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS admin_message_map (
+                admin_chat_id BIGINT NOT NULL,
+                message_id BIGINT NOT NULL,
+                user_id BIGINT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (admin_chat_id, message_id)
+            )
+        """)
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_admin_message_map_created ON admin_message_map (created_at)")
+        # Оброблені апдейти з побічними ефектами (тікети, пересилання, розсилки) — дедуплікація переживає рестарт
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS processed_updates (
+                update_id BIGINT PRIMARY KEY,
+                processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_processed_updates_at ON processed_updates (processed_at)")
+        # Стани FSM, спільні для всіх воркерів (PostgresStorage)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS fsm_storage (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data JSONB NOT NULL DEFAULT '{}',
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        # Відкриті тікети для /check_tickets (keyset по id)
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_support_tickets_open ON support_tickets (id) WHERE status = 'open'
+        """)
+        # Розсилки: завдання + журнал доставки по кожному отримувачу (для відновлення після рестарту)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                id SERIAL PRIMARY KEY,
+                kind TEXT NOT NULL,              -- 'copy' (copy_message) або 'text' (send_message)
+                from_chat_id BIGINT,
+                message_id BIGINT,
+                message_text TEXT,
+                broadcast_filter TEXT,
+                admin_chat_id BIGINT,
+                status TEXT DEFAULT 'running',   -- running / done
+                total INTEGER DEFAULT 0,
+                audience_cursor BIGINT DEFAULT 0,         -- останній user_id, записаний у журнал
+                audience_complete BOOLEAN DEFAULT FALSE,  -- чи вся аудиторія вже записана в журнал
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+        """)
+        await conn.execute("""
+            ALTER TABLE broadcast_jobs
+                ADD COLUMN IF NOT EXISTS audience_cursor BIGINT DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS audience_complete BOOLEAN DEFAULT FALSE,
+                ADD COLUMN IF NOT EXISTS owner TEXT,               -- воркер, що веде розсилку
+                ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP,   -- останнє підтвердження, що воркер живий
+                ADD COLUMN IF NOT EXISTS cancel_requested BOOLEAN DEFAULT FALSE  -- /cancel_broadcast з будь-якого воркера
+        """)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+                job_id INTEGER NOT NULL,
+                user_id BIGINT NOT NULL,
+                status TEXT DEFAULT 'pending',   -- pending / sent / failed / blocked
+                error TEXT,
+                updated_at TIMESTAMP,
+                PRIMARY KEY (job_id, user_id),
+                FOREIGN KEY (job_id) REFERENCES broadcast_jobs(id) ON DELETE CASCADE
+            )
+        """)
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_broadcast_deliveries_pending
+            ON broadcast_deliveries (job_id, user_id) WHERE status = 'pending'
+        """)
+    await prune_retained_tables()
     logging.info("База даних PostgreSQL ініціалізована.")
 
+async def prune_retained_tables() -> int:
+    """
+    Видаляє застарілі зв'язки повідомлень адмінів (REPLY_MAP_RETENTION_DAYS) та оброблені апдейти
+    (DEDUP_RETENTION_HOURS). Викликається при старті й періодично з run_worker_maintenance.
+    """
+    global pool
+    async with pool.acquire() as conn:
+        replies = await conn.execute(
+            "DELETE FROM admin_message_map WHERE created_at < NOW() - make_interval(days => $1)",
+            REPLY_MAP_RETENTION_DAYS
+        )
+        updates = await conn.execute(
+            "DELETE FROM processed_updates WHERE processed_at < NOW() - make_interval(hours => $1)",
+            DEDUP_RETENTION_HOURS
+        )
+    return int(replies.split()[-1]) + int(updates.split()[-1])
+
 async def populate_folders_if_empty():
     """Заповнює папки за замовчуванням, якщо вони порожні."""
     global pool
@@ -139,19 +729,42 @@ async def populate_folders_if_empty():
             try:
                 await conn.executemany("INSERT INTO folders (name) VALUES ($1)",
                                        [(name,) for name in folders_to_add])
+                invalidate_folders_cache()
                 logging.info("Папки за замовчуванням додано.")
             except asyncpg.exceptions.UniqueViolationError:
                 logging.warning("Помилка: Папка вже існує (це дивно, але ігноруємо).")
         
 async def log_support_ticket(user_id: int, user_name: str, text: str):
+    """
+    Додає повідомлення до відкритого тікета користувача (або відкриває новий) одним запитом:
+    upsert по частковому унікальному індексу + вставка в support_ticket_messages.
+    """
     global pool
     try:
         async with pool.acquire() as conn:
-            await conn.execute(
-                "INSERT INTO support_tickets (user_id, user_name, message_text) VALUES ($1, $2, $3)",
+            row = await conn.fetchrow(
+                """
+                WITH ticket AS (
+                    INSERT INTO support_tickets (user_id, user_name, message_text, updated_at)
+                    VALUES ($1, $2, $3, CURRENT_TIMESTAMP)
+                    ON CONFLICT (user_id) WHERE status = 'open' DO UPDATE SET
+                        user_name = EXCLUDED.user_name,
+                        message_text = EXCLUDED.message_text,
+                        updated_at = EXCLUDED.updated_at,
+                        message_count = support_tickets.message_count + 1
+                    RETURNING id, message_count
+                ), appended AS (
+                    INSERT INTO support_ticket_messages (ticket_id, message_text)
+                    SELECT id, $3 FROM ticket
+                )
+                SELECT id, message_count FROM ticket
+                """,
                 user_id, user_name, text
             )
-        logging.info(f"Створено новий тікет (ID: {user_id}) зі статусом 'open'.")
+        if row['message_count'] == 1:
+            logging.info(f"Створено новий тікет #{row['id']} (ID: {user_id}) зі статусом 'open'.")
+        else:
+            logging.info(f"Повідомлення додано до відкритого тікета #{row['id']} (ID: {user_id}), всього {row['message_count']}.")
     except Exception as e:
         logging.error(f"Помилка створення тікету: {e}")
 
@@ -159,34 +772,111 @@ async def close_support_ticket(user_id: int, admin_id: int):
     global pool
     try:
         async with pool.acquire() as conn:
-            ticket_id = await conn.fetchval(
-                "SELECT id FROM support_tickets WHERE user_id = $1 AND status = 'open' ORDER BY created_at DESC LIMIT 1",
-                user_id
+            row = await conn.fetchrow(
+                """
+                UPDATE support_tickets
+                SET status = 'closed', closed_at = CURRENT_TIMESTAMP, closed_by_admin_id = $2
+                WHERE user_id = $1 AND status = 'open'
+                RETURNING id, message_count
+                """,
+                user_id, admin_id
             )
-            if ticket_id:
-                await conn.execute(
-                    "UPDATE support_tickets SET status = 'closed', closed_at = CURRENT_TIMESTAMP, closed_by_admin_id = $1 WHERE id = $2",
-                    admin_id, ticket_id
-                )
-                logging.info(f"Тікет {ticket_id} (від User ID: {user_id}) закрито адміном {admin_id}.")
-            else:
-                logging.warning(f"Адмін {admin_id} відповів {user_id}, але відкритих тікетів для нього не знайдено.")
+        if row:
+            logging.info(f"Тікет {row['id']} (від User ID: {user_id}, повідомлень: {row['message_count']}) закрито адміном {admin_id}.")
+        else:
+            logging.warning(f"Адмін {admin_id} відповів {user_id}, але відкритих тікетів для нього не знайдено.")
     except Exception as e:
         logging.error(f"Помилка закриття тікету: {e}")
 
-async def get_open_tickets() -> list:
+async def fetch_keyset_page(source: str, columns: str, key: str, direction: str = 'next', cursor: int = 0,
+                            where: str = "TRUE", page_size: int = ADMIN_PAGE_SIZE) -> tuple:
+    """
+    Одна сторінка (rows, has_prev, has_next) з keyset-пагінацією по цілочисельному ключу:
+    direction='next' — рядки з key > cursor, 'prev' — з key < cursor. Читається лише page_size + 1 рядок по індексу.
+    """
+    operator, order = ('<', 'DESC') if direction == 'prev' else ('>', 'ASC')
+    global pool
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            f"SELECT {columns} FROM {source} WHERE ({where}) AND {key} {operator} $1 ORDER BY {key} {order} LIMIT $2",
+            cursor, page_size + 1
+        )
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if direction == 'prev':
+        rows.reverse()
+        return rows, has_more, True
+    return rows, cursor > 0, has_more
+
+async def get_users_page(direction: str = 'next', cursor: int = 0) -> tuple:
+    return await fetch_keyset_page(
+        "users", "user_id, username, full_name, phone_number, status", "user_id", direction, cursor
+    )
+
+async def get_open_tickets_page(direction: str = 'next', cursor: int = 0) -> tuple:
+    return await fetch_keyset_page(
+        "support_tickets", "id, user_id, user_name, message_text, message_count, created_at, updated_at", "id", direction, cursor,
+        where="status = 'open'"
+    )
+
+async def count_rows(source: str, where: str = "TRUE") -> int:
+    global pool
+    async with pool.acquire() as conn:
+        return await conn.fetchval(f"SELECT COUNT(*) FROM {source} WHERE {where}")
+
+async def save_admin_message_map(user_id: int, delivered: dict):
+    """Запам'ятовує, що повідомлення {admin_chat_id: [message_id, ...]} належать користувачу user_id."""
+    chat_ids, message_ids = [], []
+    for admin_chat_id, ids in delivered.items():
+        for message_id in ids:
+            chat_ids.append(admin_chat_id)
+            message_ids.append(message_id)
+            reply_target_cache.set((admin_chat_id, message_id), user_id)
+    if not chat_ids:
+        return
+    global pool
+    async with pool.acquire() as conn:
+        await conn.execute(
+            """
+            INSERT INTO admin_message_map (admin_chat_id, message_id, user_id)
+            SELECT chat_id, message_id, $3 FROM unnest($1::BIGINT[], $2::BIGINT[]) AS m(chat_id, message_id)
+            ON CONFLICT (admin_chat_id, message_id) DO NOTHING
+            """,
+            chat_ids, message_ids, user_id
+        )
+
+async def get_reply_target(admin_chat_id: int, message_id: int) -> Optional[int]:
+    """user_id автора повідомлення, на яке відповідає адмін: кеш або один запит по первинному ключу."""
+    key = (admin_chat_id, message_id)
+    user_id = reply_target_cache.get(key)
+    if user_id is not None:
+        return user_id
+    global pool
+    async with pool.acquire() as conn:
+        user_id = await conn.fetchval(
+            "SELECT user_id FROM admin_message_map WHERE admin_chat_id = $1 AND message_id = $2",
+            admin_chat_id, message_id
+        )
+    if user_id is not None:
+        reply_target_cache.set(key, user_id)
+    return user_id
+
+async def claim_update(update_id: int) -> bool:
+    """Позначає апдейт обробленим. False — його вже обробив цей або попередній процес."""
     global pool
     async with pool.acquire() as conn:
-        tickets = await conn.fetch(
-            "SELECT user_id, user_name, message_text, created_at FROM support_tickets WHERE status = 'open' ORDER BY created_at ASC"
+        claimed = await conn.fetchval(
+            "INSERT INTO processed_updates (update_id) VALUES ($1) ON CONFLICT (update_id) DO NOTHING RETURNING update_id",
+            update_id
         )
-    return tickets 
+    return claimed is not None
 
 async def add_new_folder(name: str) -> bool:
     global pool
     async with pool.acquire() as conn:
         try:
             await conn.execute("INSERT INTO folders (name) VALUES ($1)", name)
+            invalidate_folders_cache()
             return True
         except asyncpg.exceptions.UniqueViolationError:
             return False
@@ -201,6 +891,8 @@ async def delete_folder_by_name(name: str) -> bool:
             
             await conn.execute("DELETE FROM posts WHERE folder_id = $1", folder_id)
             await conn.execute("DELETE FROM folders WHERE id = $1", folder_id)
+            invalidate_folders_cache()
+            invalidate_posts_cache(folder_id)
             logging.info(f"Папку ID {folder_id} ({name}) та її пости видалено.")
             return True
         except Exception as e:
@@ -213,6 +905,7 @@ async def delete_post_by_id(post_id: int) -> (bool, Optional[int]):
         try:
             result = await conn.fetchrow("DELETE FROM posts WHERE id = $1 RETURNING folder_id", post_id)
             if result:
+                invalidate_posts_cache(result['folder_id'])
                 logging.info(f"Пост ID {post_id} видалено з бази.")
                 return True, result['folder_id']
             else:
@@ -225,8 +918,9 @@ async def delete_post_by_title(title: str) -> bool:
     global pool
     async with pool.acquire() as conn:
         try:
-            result = await conn.execute("DELETE FROM posts WHERE post_title = $1", title)
-            if 'DELETE 1' in result:
+            result = await conn.fetch("DELETE FROM posts WHERE post_title = $1 RETURNING folder_id", title)
+            if len(result) == 1:
+                invalidate_posts_cache(result[0]['folder_id'])
                 logging.info(f"Пост '{title}' видалено з бази.")
                 return True
             else:
@@ -235,64 +929,169 @@ async def delete_post_by_title(title: str) -> bool:
             logging.error(f"Помилка при видаленні поста: {e}")
             return False
 
-async def add_user(user_id: int, username: str, full_name: str, phone_number: str = None):
+def normalize_phone(phone: Optional[str]) -> Optional[str]:
+    """Ключ для пошуку за телефоном: останні 9 цифр (+380 66 123-45-67 -> '661234567')."""
+    digits_only = re.sub(r'\D', '', phone or '')
+    return digits_only[-9:] or None
+
+def split_identifiers(identifiers: list) -> tuple:
+    """
+    Розбирає список ID/телефонів на (user_id для пошуку за ID, ключі phone_key).
+    Телефоном вважаємо те, що починається з '+' або '0', або має 11+ цифр.
+    """
+    user_ids, phone_keys = [], []
+    for identifier in identifiers:
+        identifier = identifier.strip()
+        digits_only = re.sub(r'\D', '', identifier)
+        if not digits_only:
+            continue
+        if identifier.isdigit() and len(digits_only) <= 18:
+            user_ids.append(int(digits_only))
+        if identifier.startswith(('+', '0')) or len(digits_only) >= 11:
+            phone_keys.append(normalize_phone(digits_only))
+    return user_ids, phone_keys
+
+USER_PROFILE_COLUMNS = "user_id, username, full_name, phone_number, tags, status"
+
+async def add_user(user_id: int, username: str, full_name: str, phone_number: str = None) -> dict:
+    """Один upsert, що повертає актуальний профіль користувача (і кладе його в кеш)."""
     global pool
     async with pool.acquire() as conn:
-        await conn.execute(
-            """
-            INSERT INTO users (user_id, username, full_name, phone_number) 
-            VALUES ($1, $2, $3, $4)
+        row = await conn.fetchrow(
+            f"""
+            INSERT INTO users (user_id, username, full_name, phone_number, phone_key) 
+            VALUES ($1, $2, $3, $4, $5)
             ON CONFLICT (user_id) DO UPDATE SET
                 username = EXCLUDED.username,
                 full_name = EXCLUDED.full_name,
-                phone_number = COALESCE($4, users.phone_number)
+                phone_number = COALESCE($4, users.phone_number),
+                phone_key = COALESCE($5, users.phone_key),
+                status = 'active',
+                blocked_at = NULL
+            RETURNING {USER_PROFILE_COLUMNS}
+            """,
+            user_id, username, full_name, phone_number, normalize_phone(phone_number)
+        )
+    profile = dict(row)
+    invalidate_user_cache([user_id])
+    user_profile_cache.set(user_id, profile)
+    return profile
+
+async def get_user_profile(user_id: int) -> Optional[dict]:
+    """Увесь рядок користувача одним запитом (з кешем). None, якщо користувача немає в базі."""
+    profile = user_profile_cache.get(user_id)
+    if profile is not None:
+        return profile
+
+    global pool
+    generation = user_profile_cache.generation
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(f"SELECT {USER_PROFILE_COLUMNS} FROM users WHERE user_id = $1", user_id)
+    if row is None:
+        return None
+    profile = dict(row)
+    user_profile_cache.set(user_id, profile, generation)
+    return profile
+
+async def update_user_tags(user_id: int, action: str, tag: str) -> Optional[list]:
+    """
+    Атомарно змінює мітки одним UPDATE (без читання-зміни-запису в Python).
+    action: 'add', 'del' або 'set' (порожній tag для 'set' очищає всі мітки).
+    Повертає новий список міток або None, якщо нічого не змінилося (мітка вже є / не знайдена / немає користувача).
+    """
+    if action == 'add':
+        query = "UPDATE users SET tags = array_append(tags, $2) WHERE user_id = $1 AND NOT tags @> ARRAY[$2] RETURNING tags"
+        args = (user_id, tag)
+    elif action == 'del':
+        query = "UPDATE users SET tags = array_remove(tags, $2) WHERE user_id = $1 AND tags @> ARRAY[$2] RETURNING tags"
+        args = (user_id, tag)
+    elif action == 'set':
+        query = "UPDATE users SET tags = $2::TEXT[] WHERE user_id = $1 RETURNING tags"
+        args = (user_id, [tag] if tag else [])
+    else:
+        raise ValueError(f"Невідома дія з мітками: {action}")
+
+    global pool
+    async with pool.acquire() as conn:
+        tags = await conn.fetchval(query, *args)
+    invalidate_user_cache([user_id])
+    return list(tags) if tags is not None else None
+
+async def mark_user_active(user_id: int):
+    """Користувач знову пише боту — повертаємо його в розсилки."""
+    global pool
+    async with pool.acquire() as conn:
+        await conn.execute("UPDATE users SET status = 'active', blocked_at = NULL WHERE user_id = $1", user_id)
+    invalidate_user_cache([user_id])
+
+async def mark_user_unreachable(user_id: int, error: str = ''):
+    """Позначає користувача як 'blocked' або 'deactivated' після TelegramForbiddenError."""
+    global pool
+    status = 'deactivated' if 'deactivated' in (error or '').lower() else 'blocked'
+    async with pool.acquire() as conn:
+        await conn.execute(
+            "UPDATE users SET status = $2, blocked_at = CURRENT_TIMESTAMP WHERE user_id = $1",
+            user_id, status
+        )
+    invalidate_user_cache([user_id])
+    logging.info(f"Користувача {user_id} позначено як '{status}'.")
+
+async def get_inactive_users(limit: int = 30) -> tuple:
+    """Повертає (загальна кількість, перші `limit` заблокованих/видалених користувачів)."""
+    global pool
+    async with pool.acquire() as conn:
+        total = await conn.fetchval("SELECT COUNT(*) FROM users WHERE status <> 'active'")
+        rows = await conn.fetch(
+            """
+            SELECT user_id, username, full_name, status, blocked_at FROM users
+            WHERE status <> 'active'
+            ORDER BY blocked_at DESC NULLS LAST
+            LIMIT $1
             """,
-            user_id, username, full_name, phone_number
+            limit
         )
+    return total, rows
 
-async def get_active_users():
+async def purge_inactive_users() -> int:
     global pool
     async with pool.acquire() as conn:
-        rows = await conn.fetch("SELECT user_id FROM users")
-    return [row['user_id'] for row in rows]
+        result = await conn.fetch("DELETE FROM users WHERE status <> 'active' RETURNING user_id")
+    invalidate_user_cache()
+    logging.info(f"Видалено {len(result)} заблокованих/видалених користувачів.")
+    return len(result)
 
 async def delete_user(user_id: int):
     global pool
     async with pool.acquire() as conn:
         await conn.execute("DELETE FROM users WHERE user_id = $1", user_id)
+    invalidate_user_cache([user_id])
 
 async def delete_user_by_phone(phone_query: str) -> bool:
-    global pool
-    async with pool.acquire() as conn:
-        digits_only = re.sub(r'\D', '', phone_query)
-        search_suffix = digits_only
-        if len(digits_only) > 9:
-            search_suffix = digits_only[-9:]
-        
-        user_id = await conn.fetchval("SELECT user_id FROM users WHERE phone_number LIKE $1", '%' + search_suffix)
-        
-        if user_id:
-            await conn.execute("DELETE FROM users WHERE user_id = $1", user_id)
-            return True
-        else:
-            return False
+    user_id = await get_user_id_by_phone_strict(phone_query)
+    if user_id:
+        await delete_user(user_id)
+        return True
+    else:
+        return False
 
 async def delete_users_by_list(identifiers: list) -> int:
     global pool
     if not identifiers:
         return 0
     
+    user_ids, phone_keys = split_identifiers(identifiers)
     async with pool.acquire() as conn:
         try:
             result = await conn.fetch(
                 """
                 DELETE FROM users
-                WHERE CAST(user_id AS TEXT) = ANY($1::TEXT[]) OR phone_number = ANY($1::TEXT[])
+                WHERE user_id = ANY($1::BIGINT[]) OR phone_key = ANY($2::TEXT[])
                 RETURNING user_id
                 """,
-                identifiers
+                user_ids, phone_keys
             )
             deleted_count = len(result)
+            invalidate_user_cache([row['user_id'] for row in result])
             logging.info(f"Видалено {deleted_count} користувачів за списком.")
             return deleted_count
         except Exception as e:
@@ -301,58 +1100,77 @@ async def delete_users_by_list(identifiers: list) -> int:
 
 async def get_user_id_by_phone_strict(phone_query: str) -> Optional[int]:
     global pool
+    search_key = normalize_phone(phone_query)
+    if not search_key:
+        return None
+
     async with pool.acquire() as conn:
-        digits_only = re.sub(r'\D', '', phone_query)
-        search_suffix = digits_only
-        if len(digits_only) > 9:
-            search_suffix = digits_only[-9:]
-        
-        user_to_find = await conn.fetchval("SELECT user_id FROM users WHERE phone_number LIKE $1", '%' + search_suffix)
+        if len(search_key) == 9:
+            # Повний ключ — пошук по індексу idx_users_phone_key
+            user_to_find = await conn.fetchval("SELECT user_id FROM users WHERE phone_key = $1 LIMIT 1", search_key)
+        else:
+            # Короткий фрагмент номера: індекс не допоможе, шукаємо за закінченням ключа
+            user_to_find = await conn.fetchval("SELECT user_id FROM users WHERE phone_key LIKE $1 LIMIT 1", '%' + search_key)
         
         if user_to_find:
             return user_to_find 
         else:
             return None 
 
-async def get_users_by_query(query: str):
+def like_pattern(query: str) -> str:
+    """Шаблон '%запит%' для (I)LIKE з екрануванням %, _ та \\ у самому запиті."""
+    escaped = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"%{escaped}%"
+
+async def search_users(query: str, limit: int = ADMIN_PAGE_SIZE, offset: int = 0, count_total: bool = True) -> tuple:
+    """
+    Пошук без урахування регістру за частиною імені, username або телефону.
+    ILIKE обслуговується триграмними GIN-індексами, результати ранжуються за схожістю (pg_trgm).
+    Повертає (загальна кількість збігів, рядки поточної сторінки); з count_total=False кількість не рахується (None).
+    """
     global pool
+    # $4 (сам запит) передається лише разом із ранжуванням: невикористаний параметр Postgres не типізує
+    if TRGM_AVAILABLE:
+        order_by = "GREATEST(similarity(full_name, $4), similarity(username, $4), similarity(phone_number, $4)) DESC, user_id"
+        args = (like_pattern(query), limit, offset, query)
+    else:
+        order_by = "user_id"
+        args = (like_pattern(query), limit, offset)
+    # Віконний COUNT проходить усі збіги, тому лише коли кількість справді потрібна (перша сторінка)
+    total_column = ", COUNT(*) OVER () AS total" if count_total else ""
     async with pool.acquire() as conn:
         rows = await conn.fetch(
-            "SELECT user_id FROM users WHERE full_name LIKE $1 OR username LIKE $1 OR phone_number LIKE $1",
-            '%' + query + '%'
+            f"""
+            SELECT user_id, username, full_name, phone_number, status{total_column}
+            FROM users
+            WHERE full_name ILIKE $1 OR username ILIKE $1 OR phone_number ILIKE $1
+            ORDER BY {order_by}
+            LIMIT $2 OFFSET $3
+            """,
+            *args
         )
-    return [row['user_id'] for row in rows]
+    if not count_total:
+        return None, rows
+    total = rows[0]['total'] if rows else 0
+    return total, rows
 
 async def get_users_by_list(identifiers: list) -> dict:
     global pool
     if not identifiers:
         return {}
 
-    # ❗❗❗ ФІКС: Підготовка ідентифікаторів для коректного пошуку ❗❗❗
-    # Ми шукаємо або за повним ID, або за суфіксом телефону
-    
-    search_terms = []
-    
-    for identifier in identifiers:
-        # 1. Додаємо оригінальний ID/Номер (якщо це повний номер)
-        search_terms.append(identifier) 
-        
-        # 2. Додаємо суфікс (якщо це номер телефону)
-        digits_only = re.sub(r'\D', '', identifier)
-        if len(digits_only) > 5:
-            # Шукаємо за останніми 9-ма цифрами, як у get_user_id_by_phone_strict
-            search_suffix = digits_only[-9:]
-            if search_suffix not in search_terms:
-                search_terms.append('%' + search_suffix) # Додаємо як шаблон пошуку
+    # Шукаємо або за повним ID, або за нормалізованим ключем телефону (обидва — по індексу)
+    user_ids, phone_keys = split_identifiers(identifiers)
         
     async with pool.acquire() as conn:
         results = await conn.fetch(
             """
             SELECT user_id, phone_number, full_name
             FROM users
-            WHERE (CAST(user_id AS TEXT) = ANY($1::TEXT[]) OR phone_number = ANY($1::TEXT[]) OR phone_number LIKE ANY($1::TEXT[]))
+            WHERE status = 'active'
+              AND (user_id = ANY($1::BIGINT[]) OR phone_key = ANY($2::TEXT[]))
             """,
-            search_terms
+            user_ids, phone_keys
         )
         
     found_users = {}
@@ -371,28 +1189,531 @@ async def save_post(folder_id: int, post_title: str, message_id: int):
             "INSERT INTO posts (folder_id, post_title, message_id) VALUES ($1, $2, $3)",
             folder_id, post_title, message_id
         )
+    invalidate_posts_cache(folder_id)
     logging.info(f"Пост (MsgID: {message_id}) збережено у папку ID {folder_id}.")
 
-#
-# ❗❗❗ ФУНКЦІЯ, ЯКА БУЛА ДЛЯ NAMEERROR, ТЕЖ ПОТРІБНА: ❗❗❗
-#
-async def get_all_posts_by_folder(folder_id: int):
+_EPOCH = datetime(1970, 1, 1)
+
+def encode_post_cursor(created_at: datetime, post_id: int) -> str:
+    """Курсор сторінки (created_at у мікросекундах + id) для callback_data."""
+    return f"{(created_at - _EPOCH) // timedelta(microseconds=1)}_{post_id}"
+
+def decode_post_cursor(cursor: str) -> tuple:
+    micros, post_id = cursor.split('_')
+    return _EPOCH + timedelta(microseconds=int(micros)), int(post_id)
+
+async def get_folder_posts_page(folder_id: int, direction: str = 'next', cursor: Optional[str] = None) -> tuple:
     """
-    Отримує всі пости для заданої папки, сортуючи від старих до нових.
+    Повертає одну сторінку постів папки: (posts, has_prev, has_next).
+    Keyset-пагінація по (created_at, id): direction='next' — пости після курсора, 'prev' — перед ним.
+    Сторінки кешуються до зміни постів у цій папці.
     """
-    global pool
-    async with pool.acquire() as conn:
-        posts = await conn.fetch(
-            "SELECT id, post_title, message_id FROM posts WHERE folder_id = $1 ORDER BY created_at ASC",
-            folder_id
-        )
-    return posts
+    pages = posts_cache.get(folder_id)
+    page = pages.get((direction, cursor)) if pages is not None else None
+    if page is not None:
+        return page
 
-async def get_folders() -> list:
     global pool
+    generation = posts_cache.generation
+    limit = FOLDER_PAGE_SIZE + 1
     async with pool.acquire() as conn:
-        folders_records = await conn.fetch("SELECT id, name FROM folders")
-    return [(row['id'], row['name']) for row in folders_records]
+        if cursor is None:
+            rows = await conn.fetch(
+                """
+                SELECT id, post_title, message_id, created_at FROM posts
+                WHERE folder_id = $1
+                ORDER BY created_at, id
+                LIMIT $2
+                """,
+                folder_id, limit
+            )
+        elif direction == 'prev':
+            created_at, post_id = decode_post_cursor(cursor)
+            rows = await conn.fetch(
+                """
+                SELECT id, post_title, message_id, created_at FROM posts
+                WHERE folder_id = $1 AND (created_at, id) < ($2, $3)
+                ORDER BY created_at DESC, id DESC
+                LIMIT $4
+                """,
+                folder_id, created_at, post_id, limit
+            )
+        else:
+            created_at, post_id = decode_post_cursor(cursor)
+            rows = await conn.fetch(
+                """
+                SELECT id, post_title, message_id, created_at FROM posts
+                WHERE folder_id = $1 AND (created_at, id) > ($2, $3)
+                ORDER BY created_at, id
+                LIMIT $4
+                """,
+                folder_id, created_at, post_id, limit
+            )
+
+    posts = [tuple(row) for row in rows[:FOLDER_PAGE_SIZE]]
+    has_more = len(rows) > FOLDER_PAGE_SIZE
+    if direction == 'prev' and cursor is not None:
+        posts.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = cursor is not None, has_more
+
+    page = (posts, has_prev, has_next)
+    if pages is None:
+        pages = {}
+        posts_cache.set(folder_id, pages, generation)
+    if generation == posts_cache.generation:
+        pages[(direction, cursor)] = page
+    return page
+
+async def get_folders() -> list:
+    folders = folders_cache.get('folders')
+    if folders is not None:
+        return folders
+
+    global pool
+    generation = folders_cache.generation
+    async with pool.acquire() as conn:
+        folders_records = await conn.fetch("SELECT id, name FROM folders ORDER BY id")
+    folders = [(row['id'], row['name']) for row in folders_records]
+    folders_cache.set('folders', folders, generation)
+    return folders
+
+async def create_broadcast_job(kind: str, admin_chat_id: int, user_ids: list = None, from_chat_id: int = None,
+                               message_id: int = None, message_text: str = None, broadcast_filter: str = None) -> int:
+    """
+    Створює завдання розсилки.
+    Якщо передано user_ids — одразу записує їх у журнал зі статусом 'pending'.
+    Інакше аудиторія (усі активні або за broadcast_filter) записується в журнал посторінково під час розсилки.
+    """
+    global pool
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            job_id = await conn.fetchval(
+                """
+                INSERT INTO broadcast_jobs (kind, from_chat_id, message_id, message_text, broadcast_filter, admin_chat_id,
+                                            total, audience_complete, owner, heartbeat_at)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, CURRENT_TIMESTAMP)
+                RETURNING id
+                """,
+                kind, from_chat_id, message_id, message_text, broadcast_filter, admin_chat_id,
+                len(user_ids) if user_ids is not None else 0, user_ids is not None, worker_id()
+            )
+            if user_ids is not None:
+                await conn.execute(
+                    """
+                    INSERT INTO broadcast_deliveries (job_id, user_id)
+                    SELECT $1, uid FROM unnest($2::BIGINT[]) AS uid
+                    ON CONFLICT DO NOTHING
+                    """,
+                    job_id, list(user_ids)
+                )
+    logging.info(f"Створено завдання розсилки #{job_id} ({kind}).")
+    return job_id
+
+async def get_broadcast_job(job_id: int):
+    global pool
+    async with pool.acquire() as conn:
+        return await conn.fetchrow("SELECT * FROM broadcast_jobs WHERE id = $1", job_id)
+
+async def get_unfinished_broadcast_jobs() -> list:
+    """Незавершені розсилки, які ніхто не веде: без власника або з heartbeat, старшим за BROADCAST_LEASE_SECONDS."""
+    global pool
+    async with pool.acquire() as conn:
+        return await conn.fetch(
+            """
+            SELECT * FROM broadcast_jobs
+            WHERE status = 'running'
+              AND (owner IS NULL OR heartbeat_at IS NULL OR heartbeat_at < NOW() - make_interval(secs => $1))
+            ORDER BY id
+            """,
+            BROADCAST_LEASE_SECONDS
+        )
+
+async def claim_broadcast_job(job_id: int, owner: str):
+    """
+    Атомарно бере розсилку у виконання воркером `owner`. Повертає завдання або None,
+    якщо його вже веде інший живий воркер.
+    """
+    global pool
+    async with pool.acquire() as conn:
+        return await conn.fetchrow(
+            """
+            UPDATE broadcast_jobs SET owner = $2, heartbeat_at = CURRENT_TIMESTAMP
+            WHERE id = $1 AND status = 'running'
+              AND (owner IS NULL OR owner = $2 OR heartbeat_at IS NULL
+                   OR heartbeat_at < NOW() - make_interval(secs => $3))
+            RETURNING *
+            """,
+            job_id, owner, BROADCAST_LEASE_SECONDS
+        )
+
+async def release_broadcast_job(job_id: int, owner: str):
+    global pool
+    async with pool.acquire() as conn:
+        await conn.execute(
+            "UPDATE broadcast_jobs SET owner = NULL WHERE id = $1 AND owner = $2 AND status = 'running'",
+            job_id, owner
+        )
+
+async def renew_broadcast_lease(job_id: int, owner: str):
+    """
+    Оновлює heartbeat розсилки. Повертає запис (running — скільки розсилок зараз іде в усіх воркерах,
+    для розподілу BROADCAST_RATE; cancel_requested — чи адмін попросив її зупинити)
+    або None, якщо розсилку вже веде інший воркер.
+    """
+    global pool
+    async with pool.acquire() as conn:
+        return await conn.fetchrow(
+            """
+            UPDATE broadcast_jobs SET heartbeat_at = CURRENT_TIMESTAMP
+            WHERE id = $1 AND owner = $2
+            RETURNING GREATEST(1, (
+                SELECT COUNT(*) FROM broadcast_jobs
+                WHERE status = 'running' AND owner IS NOT NULL
+                  AND heartbeat_at > NOW() - make_interval(secs => $3)
+            )) AS running, cancel_requested
+            """,
+            job_id, owner, BROADCAST_LEASE_SECONDS
+        )
+
+async def request_broadcast_cancel(job_id: int) -> Optional[str]:
+    """
+    Просить зупинити розсилку, хоч би який воркер її вів: власник побачить прапорець при наступному heartbeat.
+    Розсилку без живого власника закриває одразу. Повертає новий статус або None, якщо активної розсилки немає.
+    """
+    global pool
+    async with pool.acquire() as conn:
+        return await conn.fetchval(
+            """
+            WITH target AS (
+                SELECT id, (owner IS NULL OR heartbeat_at IS NULL
+                            OR heartbeat_at < NOW() - make_interval(secs => $2)) AS orphaned
+                FROM broadcast_jobs WHERE id = $1 AND status = 'running'
+                FOR UPDATE
+            )
+            UPDATE broadcast_jobs j
+            SET cancel_requested = TRUE,
+                status = CASE WHEN t.orphaned THEN 'cancelled' ELSE j.status END,
+                finished_at = CASE WHEN t.orphaned THEN CURRENT_TIMESTAMP ELSE j.finished_at END
+            FROM target t
+            WHERE j.id = t.id
+            RETURNING j.status
+            """,
+            job_id, BROADCAST_LEASE_SECONDS
+        )
+
+async def get_running_broadcast_jobs() -> list:
+    """Розсилки, що зараз ідуть в усіх воркерах, з прогресом за журналом доставки (для /jobs)."""
+    global pool
+    async with pool.acquire() as conn:
+        return await conn.fetch(
+            """
+            SELECT j.id, j.kind, j.owner, j.total, j.audience_complete, j.cancel_requested,
+                   EXTRACT(EPOCH FROM NOW() - j.heartbeat_at)::INTEGER AS heartbeat_age,
+                   (SELECT COUNT(*) FROM broadcast_deliveries d
+                    WHERE d.job_id = j.id AND d.status <> 'pending') AS done
+            FROM broadcast_jobs j
+            WHERE j.status = 'running'
+            ORDER BY j.id
+            """
+        )
+
+# --- Мова сегментів аудиторії ---
+
+SEGMENT_HELP = (
+    "Умови: `tag:МІТКА` (або `#мітка`), `has_phone`, `joined>2026-01-01` (також `<`, `>=`, `<=`, `=`), "
+    "`name:текст` (з пробілами — `name:\"Іван Петренко\"`), `phone:380671234567`, `id:123456789`.\n"
+    "Оператори: `AND`, `OR`, `NOT` і дужки. Умови без оператора з'єднуються через AND.\n"
+    "Приклад: `tag:км_535 AND NOT tag:left AND has_phone AND joined>2026-01-01`"
+)
+
+SEGMENT_TOKEN_RE = re.compile(r'\(|\)|[^\s()"]+"[^"]*"|[^\s()]+')
+SEGMENT_JOINED_RE = re.compile(r'^joined(>=|<=|>|<|=)(\d{4}-\d{2}-\d{2})$', re.IGNORECASE)
+SEGMENT_KEYWORDS = ('AND', 'OR', 'NOT')
+
+
+class SegmentError(ValueError):
+    """Помилка у виразі сегмента (повідомлення показується адміну)."""
+
+
+def compile_segment_term(token: str, param) -> str:
+    """Одна умова сегмента -> SQL над індексованими колонками users. param(value) додає параметр і повертає '$N'."""
+    lowered = token.lower()
+    if lowered == 'has_phone':
+        return "phone_key IS NOT NULL"
+    if token.startswith('#') and len(token) > 1:
+        return f"tags @> ARRAY[{param(lowered[1:])}]::TEXT[]"
+
+    joined = SEGMENT_JOINED_RE.match(token)
+    if joined:
+        operator, date_str = joined.groups()
+        try:
+            day = datetime.strptime(date_str, '%Y-%m-%d')
+        except ValueError:
+            raise SegmentError(f"Некоректна дата '{date_str}' (формат РРРР-ММ-ДД).")
+        if operator == '=':
+            return f"(joined_at >= {param(day)} AND joined_at < {param(day + timedelta(days=1))})"
+        if operator in ('>', '<='):
+            # joined>2026-01-01 — після цього дня, тобто з початку наступного
+            day += timedelta(days=1)
+            operator = '>=' if operator == '>' else '<'
+        return f"joined_at {operator} {param(day)}"
+
+    key, sep, value = token.partition(':')
+    key = key.lower()
+    value = value.strip('"').strip()
+    if sep and not value:
+        raise SegmentError(f"Порожнє значення в умові '{token}'.")
+    if sep and key == 'tag':
+        return f"tags @> ARRAY[{param(value.lower())}]::TEXT[]"
+    if sep and key == 'name':
+        p = param(like_pattern(value))
+        return f"(full_name ILIKE {p} OR username ILIKE {p})"
+    if sep and key == 'phone':
+        phone_key = normalize_phone(value)
+        if not phone_key:
+            raise SegmentError(f"У '{token}' немає цифр телефону.")
+        return f"phone_key = {param(phone_key)}" if len(phone_key) == 9 else f"phone_key LIKE {param('%' + phone_key)}"
+    if sep and key == 'id':
+        if not value.isdigit():
+            raise SegmentError(f"ID має бути числом: '{token}'.")
+        return f"user_id = {param(int(value))}"
+    raise SegmentError(f"Невідома умова '{token}'.")
+
+
+def compile_segment(expression: str, first_param: int = 1) -> tuple:
+    """
+    Компілює вираз сегмента (див. SEGMENT_HELP) у параметризовану SQL-умову для таблиці users.
+    Повертає (sql, args), нумерація параметрів з $first_param. При помилці — SegmentError.
+    """
+    tokens = SEGMENT_TOKEN_RE.findall(expression or "")
+    if not tokens:
+        raise SegmentError("Порожній вираз сегмента.")
+    args = []
+    pos = 0
+
+    def param(value) -> str:
+        args.append(value)
+        return f"${first_param + len(args) - 1}"
+
+    def peek() -> Optional[str]:
+        return tokens[pos].upper() if pos < len(tokens) else None
+
+    def parse_or() -> str:
+        nonlocal pos
+        parts = [parse_and()]
+        while peek() == 'OR':
+            pos += 1
+            parts.append(parse_and())
+        return parts[0] if len(parts) == 1 else "(" + " OR ".join(parts) + ")"
+
+    def parse_and() -> str:
+        nonlocal pos
+        parts = [parse_not()]
+        while peek() not in (None, 'OR', ')'):
+            if peek() == 'AND':
+                pos += 1
+            parts.append(parse_not())
+        return parts[0] if len(parts) == 1 else "(" + " AND ".join(parts) + ")"
+
+    def parse_not() -> str:
+        nonlocal pos
+        if peek() == 'NOT':
+            pos += 1
+            return f"NOT ({parse_not()})"
+        return parse_atom()
+
+    def parse_atom() -> str:
+        nonlocal pos
+        if pos >= len(tokens):
+            raise SegmentError("Вираз обірвався: очікувалась умова.")
+        token = tokens[pos]
+        pos += 1
+        if token == '(':
+            inner = parse_or()
+            if peek() != ')':
+                raise SegmentError("Не вистачає закриваючої дужки ')'.")
+            pos += 1
+            return inner
+        if token == ')' or token.upper() in SEGMENT_KEYWORDS:
+            raise SegmentError(f"Неочікуване '{token}'.")
+        return compile_segment_term(token, param)
+
+    sql = parse_or()
+    if pos < len(tokens):
+        raise SegmentError(f"Неочікуване '{tokens[pos]}'.")
+    return sql, args
+
+
+def build_audience_condition(broadcast_filter: Optional[str], first_param: int = 1) -> tuple:
+    """
+    Повертає (SQL-умову для таблиці users, список параметрів), нумерація параметрів з $first_param.
+    broadcast_filter — вираз сегмента (compile_segment). Заблоковані та видалені користувачі в аудиторію не потрапляють.
+    """
+    if not broadcast_filter:
+        return "status = 'active'", []
+    condition, args = compile_segment(broadcast_filter, first_param)
+    return f"status = 'active' AND {condition}", args
+
+async def count_audience(broadcast_filter: Optional[str]) -> int:
+    """Розмір аудиторії сегмента одним COUNT(*) по індексах — без створення розсилки."""
+    condition, args = build_audience_condition(broadcast_filter)
+    global pool
+    async with pool.acquire() as conn:
+        return await conn.fetchval(f"SELECT COUNT(*) FROM users WHERE {condition}", *args)
+
+def effective_broadcast_rate() -> float:
+    """Швидкість однієї розсилки, коли інших немає: BROADCAST_RATE, але не більше за загальний OUTBOUND_RATE."""
+    return min(BROADCAST_RATE, OUTBOUND_RATE)
+
+def estimate_broadcast_duration(recipients: int) -> str:
+    """Орієнтовний час розсилки за effective_broadcast_rate(), у вигляді 'Х год Y хв Z с'."""
+    rate = effective_broadcast_rate()
+    seconds = int(recipients / rate + 0.999) if rate > 0 else 0
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f"{hours} год {minutes} хв"
+    if minutes:
+        return f"{minutes} хв {seconds} с"
+    return f"{seconds} с"
+
+async def iter_pending_recipients(job_id: int, page_size: int = RECIPIENT_PAGE_SIZE):
+    """Посторінково (keyset по user_id) віддає отримувачів зі статусом 'pending' як array('q')."""
+    global pool
+    cursor = 0
+    while True:
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(
+                """
+                SELECT user_id FROM broadcast_deliveries
+                WHERE job_id = $1 AND status = 'pending' AND user_id > $2
+                ORDER BY user_id
+                LIMIT $3
+                """,
+                job_id, cursor, page_size
+            )
+        if not rows:
+            return
+        page = array('q', (row['user_id'] for row in rows))
+        del rows
+        cursor = page[-1]
+        yield page
+        if len(page) < page_size:
+            return
+
+async def stage_audience_page(job, cursor: int, page_size: int = RECIPIENT_PAGE_SIZE):
+    """
+    Одним запитом бере наступну сторінку аудиторії з users (keyset по user_id),
+    записує її в журнал доставки і зсуває курсор завдання.
+    Повертає (щойно записані отримувачі як array('q'), новий курсор, чи вся аудиторія вже записана).
+    """
+    global pool
+    condition, args = build_audience_condition(job['broadcast_filter'], first_param=4)
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(
+            f"""
+            WITH page AS (
+                SELECT user_id FROM users
+                WHERE user_id > $2 AND {condition}
+                ORDER BY user_id
+                LIMIT $3
+            ), staged AS (
+                INSERT INTO broadcast_deliveries (job_id, user_id)
+                SELECT $1, user_id FROM page
+                ON CONFLICT DO NOTHING
+                RETURNING user_id
+            ), progress AS (
+                UPDATE broadcast_jobs
+                SET audience_cursor = COALESCE((SELECT MAX(user_id) FROM page), audience_cursor),
+                    audience_complete = (SELECT COUNT(*) FROM page) < $3,
+                    total = total + (SELECT COUNT(*) FROM staged)
+                WHERE id = $1
+                RETURNING audience_cursor, audience_complete
+            )
+            SELECT (SELECT array_agg(user_id ORDER BY user_id) FROM staged) AS staged_ids,
+                   audience_cursor, audience_complete
+            FROM progress
+            """,
+            job['id'], cursor, page_size, *args
+        )
+    page = array('q', row['staged_ids'] or [])
+    return page, row['audience_cursor'], row['audience_complete']
+
+async def iter_job_recipients(job):
+    """
+    Потік отримувачів для завдання розсилки: спершу ті, що вже є в журналі і ще 'pending'
+    (відновлення після рестарту), потім — решта аудиторії, сторінка за сторінкою.
+    Пам'ять не залежить від розміру аудиторії, а відправка починається з першої сторінки.
+    """
+    async for page in iter_pending_recipients(job['id']):
+        yield page
+
+    cursor, complete = job['audience_cursor'] or 0, job['audience_complete']
+    while not complete:
+        page, cursor, complete = await stage_audience_page(job, cursor)
+        if page:
+            yield page
+
+class BroadcastLeaseLost(RuntimeError):
+    """Розсилку веде інший воркер: цей більше не має права писати в її журнал."""
+
+
+async def save_delivery_results(job_id: int, results: list, owner: str):
+    """
+    Записує пачку результатів [(user_id, status, error), ...] одним запитом.
+    Отримувачів зі статусом 'blocked' одразу виключаємо з наступних розсилок (users.status).
+    Пише лише власник розсилки (`owner`); інакше нічого не змінює і кидає BroadcastLeaseLost.
+    """
+    global pool
+    if not results:
+        return
+    user_ids, statuses, errors = zip(*results)
+    async with pool.acquire() as conn:
+        owned = await conn.fetchval(
+            """
+            WITH owned AS (
+                SELECT 1 FROM broadcast_jobs WHERE id = $1 AND owner = $5
+            ), v AS (
+                SELECT * FROM unnest($2::BIGINT[], $3::TEXT[], $4::TEXT[]) AS v(user_id, status, error)
+                WHERE EXISTS (SELECT 1 FROM owned)
+            ), ledger AS (
+                UPDATE broadcast_deliveries d
+                SET status = v.status, error = v.error, updated_at = CURRENT_TIMESTAMP
+                FROM v
+                WHERE d.job_id = $1 AND d.user_id = v.user_id
+            ), blocked AS (
+                UPDATE users u
+                SET status = CASE WHEN v.error ILIKE '%deactivated%' THEN 'deactivated' ELSE 'blocked' END,
+                    blocked_at = CURRENT_TIMESTAMP
+                FROM v
+                WHERE v.status = 'blocked' AND u.user_id = v.user_id
+            )
+            SELECT EXISTS (SELECT 1 FROM owned)
+            """,
+            job_id, list(user_ids), list(statuses), list(errors), owner
+        )
+    if not owned:
+        raise BroadcastLeaseLost(f"розсилку #{job_id} веде інший воркер")
+    invalidate_user_cache([uid for uid, status, _ in results if status == 'blocked'])
+
+async def get_broadcast_job_stats(job_id: int) -> dict:
+    global pool
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT status, COUNT(*) AS cnt FROM broadcast_deliveries WHERE job_id = $1 GROUP BY status",
+            job_id
+        )
+    return {row['status']: row['cnt'] for row in rows}
+
+async def finish_broadcast_job(job_id: int, status: str = 'done'):
+    global pool
+    async with pool.acquire() as conn:
+        await conn.execute(
+            "UPDATE broadcast_jobs SET status = $1, finished_at = CURRENT_TIMESTAMP WHERE id = $2",
+            status, job_id
+        )
 
 def escape_markdown(text):
     if text is None:
@@ -404,6 +1725,262 @@ def escape_html(text: str) -> str:
         return ''
     return html.escape(str(text))
 
+# --- ЕКСПОРТ / ІМПОРТ ДАНИХ (COPY) ---
+
+# Набори даних для /export_csv: джерело, дозволені колонки (назва -> SQL-вираз) і колонки за замовчуванням.
+# Назви колонок з запиту адміна приймаються лише з цього списку, тому в SQL не потрапляє довільний текст.
+EXPORT_DATASETS = {
+    'users': {
+        'source': "users",
+        'order': "user_id",
+        'columns': {
+            'user_id': "user_id",
+            'username': "username",
+            'full_name': "full_name",
+            'phone_number': "phone_number",
+            'tags': "array_to_string(tags, ',')",
+            'status': "status",
+            'joined_at': "joined_at",
+            'blocked_at': "blocked_at",
+        },
+        'default': ['user_id', 'username', 'full_name', 'phone_number'],
+    },
+    'posts': {
+        'source': "posts p LEFT JOIN folders f ON f.id = p.folder_id",
+        'order': "p.id",
+        'columns': {
+            'id': "p.id",
+            'folder': "f.name",
+            'post_title': "p.post_title",
+            'message_id': "p.message_id",
+            'created_at': "p.created_at",
+        },
+        'default': ['id', 'folder', 'post_title', 'message_id', 'created_at'],
+    },
+    'tickets': {
+        'source': "support_tickets",
+        'order': "id",
+        'columns': {
+            'id': "id",
+            'user_id': "user_id",
+            'user_name': "user_name",
+            'message_text': "message_text",
+            'status': "status",
+            'created_at': "created_at",
+            'closed_at': "closed_at",
+            'closed_by_admin_id': "closed_by_admin_id",
+            'message_count': "message_count",
+            'updated_at': "updated_at",
+        },
+        'default': ['id', 'user_id', 'user_name', 'message_text', 'message_count', 'status', 'created_at', 'closed_at'],
+    },
+    'ticket_messages': {
+        'source': "support_ticket_messages m JOIN support_tickets t ON t.id = m.ticket_id",
+        'order': "m.id",
+        'columns': {
+            'id': "m.id",
+            'ticket_id': "m.ticket_id",
+            'user_id': "t.user_id",
+            'user_name': "t.user_name",
+            'message_text': "m.message_text",
+            'created_at': "m.created_at",
+        },
+        'default': ['id', 'ticket_id', 'user_id', 'user_name', 'message_text', 'created_at'],
+    },
+    'broadcasts': {
+        'source': """broadcast_jobs j LEFT JOIN LATERAL (
+                SELECT COUNT(*) FILTER (WHERE d.status = 'sent') AS sent,
+                       COUNT(*) FILTER (WHERE d.status = 'failed') AS failed,
+                       COUNT(*) FILTER (WHERE d.status = 'blocked') AS blocked
+                FROM broadcast_deliveries d WHERE d.job_id = j.id
+            ) d ON TRUE""",
+        'order': "j.id",
+        'columns': {
+            'id': "j.id",
+            'kind': "j.kind",
+            'status': "j.status",
+            'segment': "j.broadcast_filter",
+            'message_text': "j.message_text",
+            'total': "j.total",
+            'sent': "d.sent",
+            'failed': "d.failed",
+            'blocked': "d.blocked",
+            'created_at': "j.created_at",
+            'finished_at': "j.finished_at",
+        },
+        'default': ['id', 'kind', 'status', 'segment', 'total', 'sent', 'failed', 'blocked', 'created_at', 'finished_at'],
+    },
+}
+EXPORT_COMPRESSIONS = {'csv': None, 'gz': 'gz', 'gzip': 'gz', 'zip': 'zip'}
+
+
+def parse_export_args(args: list) -> tuple:
+    """
+    Розбирає аргументи /export_csv у будь-якому порядку: набір даних, колонки через кому, формат (gz/zip).
+    Повертає (dataset, columns, compression). Некоректні аргументи -> ValueError з текстом для адміна.
+    """
+    dataset, columns, compression = 'users', None, None
+    for arg in args:
+        lowered = arg.lower()
+        if lowered in EXPORT_DATASETS:
+            dataset = lowered
+        elif lowered in EXPORT_COMPRESSIONS:
+            compression = EXPORT_COMPRESSIONS[lowered]
+        else:
+            columns = [c.strip() for c in lowered.split(',') if c.strip()]
+
+    allowed = EXPORT_DATASETS[dataset]['columns']
+    if columns is None:
+        columns = EXPORT_DATASETS[dataset]['default']
+    unknown = [c for c in columns if c not in allowed]
+    if unknown or not columns:
+        raise ValueError(
+            f"Невідомі колонки для '{dataset}': {', '.join(unknown) or '—'}.\n"
+            f"Доступні: {', '.join(allowed)}"
+        )
+    return dataset, columns, compression
+
+
+def build_export_query(dataset: str, columns: list) -> str:
+    spec = EXPORT_DATASETS[dataset]
+    select_list = ", ".join(f'{spec["columns"][c]} AS "{c}"' for c in columns)
+    return f"SELECT {select_list} FROM {spec['source']} ORDER BY {spec['order']}"
+
+
+EXPORT_WRITE_BUFFER = 1024 * 1024  # байт CSV, що передаються потоку запису за раз
+
+
+async def export_query_to_file(query: str, path: str, compression: Optional[str], inner_name: str) -> int:
+    """
+    Стрімить результат запиту через COPY ... TO STDOUT (CSV, роздільник ';') у файл,
+    за потреби одразу стискаючи (gzip або zip). Дані йдуть шматками, у пам'яті весь набір не тримається.
+    Повертає кількість експортованих рядків.
+    """
+    global pool
+    # Запис і стиснення — блокуючі операції, тому вони йдуть у потоці; шматки COPY накопичуються до ~1 МБ
+    stack = contextlib.ExitStack()
+
+    def open_output():
+        if compression == 'gz':
+            return stack.enter_context(gzip.open(path, 'wb'))
+        if compression == 'zip':
+            archive = stack.enter_context(zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED))
+            return stack.enter_context(archive.open(inner_name, 'w', force_zip64=True))
+        return stack.enter_context(open(path, 'wb'))
+
+    buffer = bytearray()
+
+    async def write_chunk(chunk: bytes):
+        buffer.extend(chunk)
+        if len(buffer) >= EXPORT_WRITE_BUFFER:
+            data = bytes(buffer)
+            buffer.clear()
+            await asyncio.to_thread(out.write, data)
+
+    try:
+        out = await asyncio.to_thread(open_output)
+        async with pool.acquire() as conn:
+            status = await conn.copy_from_query(
+                query, output=write_chunk, format='csv', header=True, delimiter=';'
+            )
+        if buffer:
+            await asyncio.to_thread(out.write, bytes(buffer))
+    finally:
+        # Закриття дописує хвіст gzip/zip-архіву
+        await asyncio.to_thread(stack.close)
+    # asyncpg повертає статус виду 'COPY 123'
+    return int(status.split()[-1])
+
+
+# Колонки, які /import_csv бере з файлу; user_id обов'язковий, решта — за наявності
+IMPORT_USER_COLUMNS = ('user_id', 'username', 'full_name', 'phone_number', 'tags')
+IMPORT_MAX_FILE_SIZE = 20 * 1024 * 1024  # ліміт Bot API на завантаження файлів ботом
+
+
+def read_import_header(path: str) -> tuple:
+    """
+    Читає перший рядок CSV: повертає (роздільник, назви колонок для staging-таблиці).
+    Колонки, яких бот не знає (status, joined_at з експорту тощо), стають ignored_N і пропускаються.
+    """
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        header_line = f.readline()
+    delimiter = ';' if header_line.count(';') >= header_line.count(',') else ','
+    header = next(csv.reader([header_line], delimiter=delimiter), [])
+    names = [h.strip().lower() for h in header]
+    if 'user_id' not in names:
+        raise ValueError("У першому рядку файлу має бути заголовок з колонкою user_id.")
+    staged = []
+    for i, name in enumerate(names):
+        staged.append(name if name in IMPORT_USER_COLUMNS and name not in staged else f"ignored_{i}")
+    return delimiter, staged
+
+
+async def import_users_from_csv(path: str) -> dict:
+    """
+    Масовий імпорт користувачів: COPY файлу в тимчасову staging-таблицю,
+    потім один INSERT ... ON CONFLICT у users (телефон і імена оновлюються лише непорожніми значеннями,
+    як у add_user; мітки додаються до наявних). Повертає {'inserted', 'updated', 'rejected'}.
+    """
+    delimiter, staged = read_import_header(path)
+
+    def value(column: str) -> str:
+        return f"NULLIF(btrim({column}), '')" if column in staged else "NULL::TEXT"
+
+    global pool
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            columns_sql = ", ".join(f'"{c}" TEXT' for c in staged)
+            # file_row нумерує рядки в порядку файлу: при повторі user_id перемагає останній рядок
+            await conn.execute(
+                f"CREATE TEMP TABLE import_users_stage (file_row BIGINT GENERATED ALWAYS AS IDENTITY, {columns_sql}) ON COMMIT DROP"
+            )
+            # Перший рядок файлу (заголовок) COPY пропускає сам; BOM у заголовку не заважає
+            status = await conn.copy_to_table(
+                'import_users_stage', source=path, columns=staged,
+                format='csv', header=True, delimiter=delimiter, encoding='utf-8'
+            )
+            staged_rows = int(status.split()[-1])
+
+            row = await conn.fetchrow(f"""
+                WITH valid AS (
+                    SELECT DISTINCT ON (uid) *
+                    FROM (
+                        SELECT btrim(user_id)::BIGINT AS uid, file_row,
+                               {value('username')} AS username,
+                               {value('full_name')} AS full_name,
+                               {value('phone_number')} AS phone_number,
+                               array_remove(regexp_split_to_array(lower(btrim({value('tags')}, ' ,')), ' *, *'), '') AS tags
+                        FROM import_users_stage
+                        WHERE btrim(user_id) ~ '^[0-9]{{1,18}}$'
+                    ) parsed
+                    ORDER BY uid, file_row DESC
+                ), merged AS (
+                    INSERT INTO users (user_id, username, full_name, phone_number, phone_key, tags)
+                    SELECT uid, username, full_name, phone_number,
+                           NULLIF(RIGHT(regexp_replace(phone_number, '[^0-9]', '', 'g'), 9), ''),
+                           COALESCE(tags, '{{}}')
+                    FROM valid
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        username = COALESCE(EXCLUDED.username, users.username),
+                        full_name = COALESCE(EXCLUDED.full_name, users.full_name),
+                        phone_number = COALESCE(EXCLUDED.phone_number, users.phone_number),
+                        phone_key = COALESCE(EXCLUDED.phone_key, users.phone_key),
+                        -- Без дублів і в порядку першої появи: спершу наявні мітки, потім нові з файлу
+                        tags = ARRAY(
+                            SELECT tag FROM unnest(users.tags || EXCLUDED.tags) WITH ORDINALITY AS t(tag, ord)
+                            GROUP BY tag ORDER BY MIN(ord)
+                        )
+                    RETURNING (xmax = 0) AS inserted
+                )
+                SELECT COUNT(*) FILTER (WHERE inserted) AS inserted,
+                       COUNT(*) FILTER (WHERE NOT inserted) AS updated
+                FROM merged
+            """)
+    invalidate_user_cache()
+    inserted, updated = row['inserted'], row['updated']
+    return {'inserted': inserted, 'updated': updated, 'rejected': staged_rows - inserted - updated}
+
+
 # --- Клавіатури ---
 
 def get_main_keyboard():
@@ -439,9 +2016,6 @@ def get_admin_keyboard():
     return keyboard
 
 async def generate_folder_keyboard(for_admin: bool = False, is_admin_menu: bool = False) -> InlineKeyboardMarkup:
-    folders = await get_folders()
-    buttons = []
-    
     if for_admin:
         prefix = 'save_to_folder_'
     elif is_admin_menu:
@@ -449,27 +2023,70 @@ async def generate_folder_keyboard(for_admin: bool = False, is_admin_menu: bool
     else:
         prefix = 'folder_'
 
+    # Готова клавіатура з кешу (скидається разом зі списком папок)
+    markup = folders_cache.get(('keyboard', prefix))
+    if markup is not None:
+        return markup
+
+    generation = folders_cache.generation
+    folders = await get_folders()
+    buttons = []
+
     for folder_id, name in folders:
         buttons.append([InlineKeyboardButton(text=name, callback_data=f"{prefix}{folder_id}")])
     
     if for_admin:
         buttons.append([InlineKeyboardButton(text="❌ Не зберігати (Тільки розсилка)", callback_data="save_to_folder_0")])
         
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
+    markup = InlineKeyboardMarkup(inline_keyboard=buttons)
+    folders_cache.set(('keyboard', prefix), markup, generation)
+    return markup
 
-def generate_posts_list_keyboard(posts: list, is_admin: bool = False) -> InlineKeyboardMarkup:
+def generate_posts_list_keyboard(posts: list, is_admin: bool = False, folder_id: int = None,
+                                 has_prev: bool = False, has_next: bool = False) -> InlineKeyboardMarkup:
     buttons = []
-    for (post_id, title, msg_id) in posts:
+    for (post_id, title, msg_id, created_at) in posts:
         row = [
             InlineKeyboardButton(text=title, callback_data=f"view_post_{msg_id}")
         ]
         if is_admin:
             row.append(InlineKeyboardButton(text="❌ Видалити", callback_data=f"del_post_{post_id}"))
         buttons.append(row)
+
+    # Навігація між сторінками: курсор — перший/останній пост поточної сторінки.
+    # Режим меню (a — з кнопками видалення, u — без) передається далі, щоб усі сторінки виглядали як перша.
+    mode = 'a' if is_admin else 'u'
+    nav_row = []
+    if has_prev:
+        first_id, _, _, first_created = posts[0]
+        nav_row.append(InlineKeyboardButton(
+            text="◀️", callback_data=f"fpage_{mode}_{folder_id}_p_{encode_post_cursor(first_created, first_id)}"
+        ))
+    if has_next:
+        last_id, _, _, last_created = posts[-1]
+        nav_row.append(InlineKeyboardButton(
+            text="▶️", callback_data=f"fpage_{mode}_{folder_id}_n_{encode_post_cursor(last_created, last_id)}"
+        ))
+    if nav_row:
+        buttons.append(nav_row)
     
     buttons.append([InlineKeyboardButton(text="⬅️ До Головного меню", callback_data="back_to_menu")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+REPLY_ID_MARKER_RE = re.compile(r"🔑\s*ID\s*:\s*(\d{4,})", re.IGNORECASE)
+
+async def resolve_reply_target(msg: types.Message) -> Optional[int]:
+    """
+    Кому адресована відповідь адміна: спершу за таблицею admin_message_map (працює і для пересланих
+    повідомлень від користувачів із прихованою пересилкою), і лише для старих повідомлень — розбором підпису.
+    """
+    if not msg:
+        return None
+    user_id = await get_reply_target(msg.chat.id, msg.message_id)
+    if user_id is not None:
+        return user_id
+    return extract_user_id_from_reply(msg)
+
 def extract_user_id_from_reply(msg: types.Message) -> Optional[int]:
     if not msg:
         return None
@@ -486,12 +2103,10 @@ def extract_user_id_from_reply(msg: types.Message) -> Optional[int]:
     if getattr(msg, "text", None):
         text_candidates.append(msg.text)
     
-    marker_code_re = re.compile(r"🔑\s*ID\s*:\s*(\d{4,})", re.IGNORECASE)
-    
     for txt in text_candidates:
         if not txt:
             continue
-        m = marker_code_re.search(txt)
+        m = REPLY_ID_MARKER_RE.search(txt)
         if m:
             try:
                 logging.info(f"Знайдено ID {m.group(1)} у підписі (чистий текст).")
@@ -502,46 +2117,1050 @@ def extract_user_id_from_reply(msg: types.Message) -> Optional[int]:
     logging.warning("Не вдалося знайти ID у підписі через RegEx.")
     return None
 
-# --- ЛОГІКА РОЗСИЛКИ (ВИДІЛЕНА ФУНКЦІЯ) ---
-async def process_broadcast_message(content_chat_id: int, content_message_id: int, message: Message, broadcast_filter: str = None):
-    
-    if broadcast_filter:
-        users = await get_users_by_query(broadcast_filter)
-        filter_info = f"за фільтром '{broadcast_filter}' (знайдено {len(users)})"
-    else:
-        users = await get_active_users()
-        filter_info = f"усім активним користувачам ({len(users)})"
+# --- ПАГІНОВАНІ АДМІН-СПИСКИ ---
+# Кожен список — функція (direction, cursor, state) -> (текст HTML, курсор для ◀️, курсор для ▶️).
+# Курсор (ключ першого/останнього рядка або зсув) їде в callback_data 'pg:<список>:<p|n>:<курсор>',
+# тож кожна сторінка — один невеликий запит, а не вивантаження всієї таблиці.
+
+def format_user_entry(row) -> str:
+    entry = (
+        f"🔑 ID: <code>{row['user_id']}</code>\n"
+        f"👤 <b>{escape_html(row['full_name'])}</b> (@{escape_html(row['username'] or 'НЕМАЄ')})\n"
+        f"📞 Телефон: <code>{escape_html(row['phone_number'] or 'НЕМАЄ')}</code>\n"
+    )
+    if row['status'] != 'active':
+        entry += f"⛔ Статус: {row['status']}\n"
+    return entry + "----------------------------\n"
+
+async def users_listing_page(direction: str, cursor: int, state: FSMContext) -> tuple:
+    rows, has_prev, has_next = await get_users_page(direction, cursor)
+    if not rows:
+        return "База даних порожня. Записів не знайдено.", None, None
+    header = "<b>Звіт по базі даних users</b>\n"
+    if not has_prev:
+        header += f"УСЬОГО ЗАПИСІВ: <b>{await count_rows('users')}</b>\n"
+    text = header + "============================\n" + "".join(format_user_entry(row) for row in rows)
+    return text, rows[0]['user_id'] if has_prev else None, rows[-1]['user_id'] if has_next else None
+
+async def tickets_listing_page(direction: str, cursor: int, state: FSMContext) -> tuple:
+    rows, has_prev, has_next = await get_open_tickets_page(direction, cursor)
+    if not rows:
+        return "✅ Чудова робота! Усі тікети закриті. Повідомлень без відповіді немає.", None, None
+    if has_prev:
+        text = "📢 <b>ВІДКРИТІ ТІКЕТИ (продовження):</b>\n\n"
+    else:
+        open_count = await count_rows('support_tickets', "status = 'open'")
+        text = f"📢 <b>ВІДКРИТІ ТІКЕТИ ({open_count}):</b>\n\n"
+    for ticket in rows:
+        message_text = ticket['message_text'] or ''
+        preview = message_text[:100] + ('...' if len(message_text) > 100 else '')
+        last_at = ticket['updated_at'] or ticket['created_at']
+        count_info = f" · повідомлень: {ticket['message_count']}" if ticket['message_count'] > 1 else ""
+        text += (
+            f"👤 <b>{escape_html(ticket['user_name'])}</b> (ID: <code>{ticket['user_id']}</code>)\n"
+            f"<i>{last_at.strftime('%Y-%m-%d %H:%M')}{count_info}</i>\n"
+            f"💬 {escape_html(preview)}\n"
+            "--------------------\n"
+        )
+    return text, rows[0]['id'] if has_prev else None, rows[-1]['id'] if has_next else None
+
+async def find_user_listing_page(direction: str, cursor: int, state: FSMContext) -> tuple:
+    """
+    Результати /find_user ранжовані за схожістю, тому тут курсор — зсув; сам запит зберігається у FSM.
+    Загальна кількість рахується лише для першої сторінки і далі береться з FSM.
+    """
+    data = await state.get_data()
+    query = data.get('find_user_query')
+    if not query:
+        return "Запит застарів. Повторіть пошук: /find_user [Запит]", None, None
+    offset = max(cursor - ADMIN_PAGE_SIZE, 0) if direction == 'prev' else cursor
+    total = data.get('find_user_total') if offset > 0 else None
+    total_counted, rows = await search_users(query, ADMIN_PAGE_SIZE, offset, count_total=total is None)
+    if total is None:
+        total = total_counted
+        await state.update_data(find_user_total=total)
+    if not rows:
+        return f"Користувачів, які містять '{escape_html(query)}', не знайдено.", None, None
+    text = (
+        f"<b>Знайдено {total} користувачів за запитом '{escape_html(query)}'</b> "
+        f"(показано {offset + 1}–{offset + len(rows)}):\n\n"
+    )
+    text += "".join(format_user_entry(row) for row in rows)
+    next_offset = offset + len(rows)
+    return text, offset if offset > 0 else None, next_offset if next_offset < total else None
+
+ADMIN_LISTINGS = {
+    'users': users_listing_page,
+    'tickets': tickets_listing_page,
+    'find': find_user_listing_page,
+}
+
+def generate_listing_keyboard(listing: str, prev_cursor: Optional[int], next_cursor: Optional[int]) -> Optional[InlineKeyboardMarkup]:
+    nav_row = []
+    if prev_cursor is not None:
+        nav_row.append(InlineKeyboardButton(text="◀️", callback_data=f"pg:{listing}:p:{prev_cursor}"))
+    if next_cursor is not None:
+        nav_row.append(InlineKeyboardButton(text="▶️", callback_data=f"pg:{listing}:n:{next_cursor}"))
+    return InlineKeyboardMarkup(inline_keyboard=[nav_row]) if nav_row else None
+
+async def send_listing_page(event, listing: str, state: FSMContext, direction: str = 'next', cursor: int = 0):
+    """Показує сторінку списку: нове повідомлення на команду або редагування того ж повідомлення на ◀️/▶️."""
+    text, prev_cursor, next_cursor = await ADMIN_LISTINGS[listing](direction, cursor, state)
+    keyboard = generate_listing_keyboard(listing, prev_cursor, next_cursor)
+    if isinstance(event, CallbackQuery):
+        try:
+            await event.message.edit_text(text, parse_mode='HTML', reply_markup=keyboard)
+        except TelegramBadRequest as e:
+            # 'message is not modified' — повторне натискання тієї ж кнопки
+            logging.debug(f"Сторінку списку не оновлено: {e}")
+        return await respond(event.answer())
+    return await respond(event.reply(text, parse_mode='HTML', reply_markup=keyboard))
+
+
+# --- ФОНОВІ ЗАДАЧІ (довгі адмін-операції поза вебхуком) ---
+
+# Задача, у контексті якої зараз виконується код (для звітів про прогрес)
+current_background_job = contextvars.ContextVar('current_background_job', default=None)
+
+
+class BackgroundJob:
+    """Одна фонова задача: розсилка, експорт, масове видалення тощо."""
+
+    def __init__(self, job_id: int, title: str, owner_id: Optional[int] = None):
+        self.id = job_id
+        self.title = title
+        self.owner_id = owner_id
+        self.state = 'queued'            # queued / running / done / failed / cancelled
+        self.progress = ''
+        self.broadcast_job_id = None     # ID з broadcast_jobs, якщо це розсилка
+        self.cancel_requested = False
+        self.created_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def is_active(self) -> bool:
+        return self.state in ('queued', 'running')
+
+
+class TaskExecutor:
+    """
+    Обмежений виконавець фонових задач, яким володіє aiohttp-додаток.
+    Одночасно виконується не більше max_running задач, у черзі — не більше max_queued.
+    """
+
+    def __init__(self, max_running: int, max_queued: int, history_size: int = 50):
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.history_size = history_size
+        self._semaphore = asyncio.Semaphore(max_running)
+        self._jobs = {}
+        self._next_id = 1
+        self._closing = False
+
+    def submit(self, title: str, coro_factory, owner_id: Optional[int] = None) -> Optional[BackgroundJob]:
+        """
+        Ставить задачу в чергу і одразу повертає її (або None, якщо черга переповнена).
+        coro_factory — функція без аргументів, що повертає корутину.
+        """
+        active = sum(1 for job in self._jobs.values() if job.is_active)
+        if self._closing or active >= self.max_running + self.max_queued:
+            return None
+
+        job = BackgroundJob(self._next_id, title, owner_id)
+        self._next_id += 1
+        self._jobs[job.id] = job
+        job.task = asyncio.create_task(self._run(job, coro_factory))
+        self._trim_history()
+        logging.info(f"Фонова задача #{job.id} ({title}) поставлена в чергу.")
+        return job
+
+    async def _run(self, job: BackgroundJob, coro_factory):
+        current_background_job.set(job)
+        try:
+            async with self._semaphore:
+                job.state = 'running'
+                job.started_at = time.monotonic()
+                await coro_factory()
+            job.state = 'done'
+        except asyncio.CancelledError:
+            job.state = 'cancelled'
+            raise
+        except Exception as e:
+            job.state = 'failed'
+            job.progress = f"{type(e).__name__}: {e}"
+            logging.exception(f"Фонова задача #{job.id} ({job.title}) завершилась з помилкою: {e}")
+        finally:
+            job.finished_at = time.monotonic()
+
+    def _trim_history(self):
+        finished = [job_id for job_id, job in self._jobs.items() if not job.is_active]
+        for job_id in finished[:max(0, len(finished) - self.history_size)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id: int) -> Optional[BackgroundJob]:
+        return self._jobs.get(job_id)
+
+    def list_jobs(self) -> list:
+        return list(self._jobs.values())
+
+    def cancel(self, job_id: int) -> bool:
+        job = self._jobs.get(job_id)
+        if not job or not job.is_active:
+            return False
+        job.cancel_requested = True
+        job.task.cancel()
+        return True
+
+    async def shutdown(self, timeout: float):
+        """Перестає приймати задачі, чекає завершення поточних до timeout секунд, решту скасовує."""
+        self._closing = True
+        tasks = [job.task for job in self._jobs.values() if job.is_active]
+        if not tasks:
+            return
+        logging.info(f"Очікуємо завершення {len(tasks)} фонових задач (до {timeout}с)...")
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+def report_progress(text: str):
+    """Оновлює прогрес поточної фонової задачі (якщо код виконується всередині неї)."""
+    job = current_background_job.get()
+    if job:
+        job.progress = text
+
+
+task_executor: TaskExecutor = None
+
+
+async def submit_admin_job(message: Message, title: str, coro_factory) -> Optional[BackgroundJob]:
+    """Ставить адмін-операцію у фон і одразу відповідає адміну номером задачі."""
+    job = task_executor.submit(title, coro_factory, owner_id=message.chat.id)
+    if job:
+        await message.answer(f"⏳ Задачу #{job.id} ({title}) поставлено в чергу. Статус: /jobs")
+    else:
+        await message.answer("❌ Черга фонових задач переповнена. Спробуйте пізніше або перевірте /jobs.")
+    return job
+
+
+# --- ЛОГІКА РОЗСИЛКИ (ВИДІЛЕНА ФУНКЦІЯ) ---
+
+# Смуга вихідних викликів поточної задачі: 'interactive' (за замовчуванням) або 'bulk' (воркери розсилки)
+outbound_lane = contextvars.ContextVar('outbound_lane', default='interactive')
+
+# Методи Bot API, що надсилають або змінюють повідомлення і рахуються в ліміти Telegram.
+# Решта (answerCallbackQuery, getFile, setWebhook...) проходить без черги.
+THROTTLED_METHOD_PREFIXES = ('send', 'copy', 'forward', 'edit')
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """
+    Центральний планувальник усіх вихідних викликів бота (middleware сесії, тож через нього йде кожен bot.*).
+    Дві смуги: 'interactive' (відповіді, меню, сповіщення адмінам) завжди обслуговується раніше за 'bulk' (розсилки).
+    Глобальний token bucket OUTBOUND_RATE/с спільний для обох смуг; bulk додатково обмежена BROADCAST_RATE/с
+    та мінімальним інтервалом між повідомленнями в один чат. В межах смуги чати обслуговуються по колу,
+    тож один активний чат не затримує інші. Після TelegramRetryAfter видача токенів зупиняється для всіх.
+    """
+
+    LANES = ('interactive', 'bulk')
+
+    def __init__(self, rate: float, bulk_rate: float, per_chat_rate: float):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.set_bulk_rate(bulk_rate)
+        self.per_chat_interval = 1.0 / per_chat_rate if per_chat_rate > 0 else 0.0
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._bulk_next = 0.0
+        self._chat_next_slot = {}
+        # смуга -> {chat_id: deque(future)}; порядок ключів — черга чатів для обслуговування по колу
+        self._waiters = {lane: collections.OrderedDict() for lane in self.LANES}
+        self._wakeup = asyncio.Event()
+        self._pump_task: Optional[asyncio.Task] = None
+
+    def set_bulk_rate(self, bulk_rate: float):
+        self.bulk_rate = bulk_rate
+        self.bulk_interval = 1.0 / bulk_rate if bulk_rate > 0 else 0.0
+
+    async def __call__(self, make_request, bot, method):
+        if not getattr(method, '__api_method__', '').startswith(THROTTLED_METHOD_PREFIXES):
+            return await make_request(bot, method)
+        await self.acquire(getattr(method, 'chat_id', None), outbound_lane.get())
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            metrics['outbound_retry_after'] += 1
+            self.pause(e.retry_after)
+            raise
+
+    async def acquire(self, chat_id=None, lane: str = 'interactive'):
+        """Чекає своєї черги на один виклик у чат chat_id у смузі lane."""
+        if lane == 'bulk' and chat_id is not None and self.per_chat_interval:
+            now = time.monotonic()
+            slot = max(now, self._chat_next_slot.get(chat_id, 0.0))
+            self._chat_next_slot[chat_id] = slot + self.per_chat_interval
+            if len(self._chat_next_slot) > 10000:
+                # Прибираємо чати, чий інтервал уже минув, щоб словник не ріс безмежно
+                self._chat_next_slot = {k: v for k, v in self._chat_next_slot.items() if v > now}
+            if slot > now:
+                await asyncio.sleep(slot - now)
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[lane].setdefault(chat_id, collections.deque()).append(future)
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        self._wakeup.set()
+        # Якщо задачу скасують під час очікування, future теж скасується і насос її пропустить
+        await future
+
+    def _pop_waiter(self, lane: str) -> Optional[asyncio.Future]:
+        queue = self._waiters[lane]
+        while queue:
+            chat_id, futures = next(iter(queue.items()))
+            future = futures.popleft()
+            if futures:
+                queue.move_to_end(chat_id)
+            else:
+                del queue[chat_id]
+            if not future.done():
+                return future
+        return None
+
+    async def _pump(self):
+        """Видає токени: спершу interactive, потім bulk (не частіше за BROADCAST_RATE)."""
+        while True:
+            if not self._waiters['interactive'] and not self._waiters['bulk']:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._tokens = min(self.capacity, self._tokens + max(0.0, now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                continue
+
+            if self._waiters['interactive']:
+                lane = 'interactive'
+            elif now >= self._bulk_next:
+                lane = 'bulk'
+            else:
+                # Для bulk ще зарано: чекаємо або свого часу, або нового interactive-запиту
+                self._wakeup.clear()
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), self._bulk_next - now)
+                continue
+
+            future = self._pop_waiter(lane)
+            if future is None:
+                continue
+            self._tokens -= 1
+            if lane == 'bulk':
+                self._bulk_next = max(now, self._bulk_next) + self.bulk_interval
+            metrics[f'outbound_{lane}_sent'] += 1
+            future.set_result(None)
+
+    def pause(self, seconds: float):
+        """Зупиняє видачу токенів на `seconds` секунд (після 429 від Telegram)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+        self._updated = max(self._updated, self._paused_until)
+
+    def waiting(self, lane: str) -> int:
+        return sum(len(futures) for futures in self._waiters[lane].values())
+
+    async def close(self):
+        if self._pump_task:
+            self._pump_task.cancel()
+            await asyncio.gather(self._pump_task, return_exceptions=True)
+
+
+# Розсилку веде один воркер (власник оренди), тож він отримує повний BROADCAST_RATE; якщо розсилки одночасно
+# йдуть у кількох воркерах, ліміт ділиться між ними (rebalance_bulk_rate з heartbeat)
+outbound_scheduler = OutboundScheduler(OUTBOUND_RATE, BROADCAST_RATE, BROADCAST_PER_CHAT_RATE)
+bot.session.middleware(outbound_scheduler)
+metric_gauges['outbound_interactive_waiting'] = lambda: outbound_scheduler.waiting('interactive')
+metric_gauges['outbound_bulk_waiting'] = lambda: outbound_scheduler.waiting('bulk')
+metric_gauges['outbound_bulk_rate'] = lambda: outbound_scheduler.bulk_rate
+
+
+async def run_broadcast(recipients, send_one, on_result=None) -> dict:
+    """
+    Конкурентно розсилає повідомлення (BROADCAST_CONCURRENCY воркерів) у смузі 'bulk' планувальника outbound_scheduler.
+    recipients — асинхронний ітератор сторінок з user_id (див. iter_job_recipients);
+    сторінки подаються воркерам через обмежену чергу, тож у пам'яті тримається лише кілька сторінок.
+    send_one(uid) — корутина з одним викликом Bot API для користувача uid.
+    on_result(uid, status, error) — необов'язкова корутина, що отримує результат по кожному отримувачу
+    (status: 'sent' / 'failed' / 'blocked').
+    TelegramRetryAfter не рахується як помилка: планувальник стає на паузу, а повідомлення повертається в чергу.
+    """
+    queue = asyncio.Queue(maxsize=BROADCAST_CONCURRENCY * 4)
+    retries = collections.deque()
+    stats = {'sent': 0, 'failed': 0}
+
+    async def deliver(uid: int, attempt: int):
+        status, error = 'sent', None
+        try:
+            await send_one(uid)
+        except TelegramRetryAfter as e:
+            if attempt < BROADCAST_MAX_RETRIES:
+                logging.warning(f"RetryAfter {e.retry_after}с для {uid}. Пауза і повтор (спроба {attempt + 1}).")
+                retries.append((uid, attempt + 1))
+                return
+            status, error = 'failed', f"RetryAfter: {e.retry_after}"
+            logging.error(f"DEBUG: Вичерпано повтори після RetryAfter для користувача {uid}.")
+        except TelegramForbiddenError as e:
+            status, error = 'blocked', str(e)
+            logging.warning(f"INFO: Користувач {uid} заблокував бота.")
+        except (TelegramBadRequest, ClientConnectorError) as e:
+            status, error = 'failed', f"{type(e).__name__}: {e}"
+            logging.error(f"DEBUG: Помилка при відправці користувачу {uid}: {type(e).__name__} - {e}")
+        except Exception as e:
+            status, error = 'failed', f"{type(e).__name__}: {e}"
+            logging.error(f"DEBUG: Невідома помилка при відправці користувачу {uid}: {type(e).__name__} - {e}")
+
+        stats['sent' if status == 'sent' else 'failed'] += 1
+        if on_result:
+            await on_result(uid, status, error)
+
+    async def worker():
+        # Розсилка поступається відповідям користувачам і адмінам (смуга 'bulk')
+        outbound_lane.set('bulk')
+        while True:
+            # Повтори після RetryAfter мають пріоритет над новими отримувачами
+            if retries:
+                await deliver(*retries.popleft())
+                continue
+            uid = await queue.get()
+            if uid is None:
+                # Кінець потоку: доробляємо повтори, які ще могли залишитись
+                while retries:
+                    await deliver(*retries.popleft())
+                return
+            await deliver(uid, 0)
+
+    workers = [asyncio.create_task(worker()) for _ in range(BROADCAST_CONCURRENCY)]
+    try:
+        async for page in recipients:
+            for uid in page:
+                await queue.put(uid)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    return stats
+
+
+class DeliveryLedger:
+    """
+    Буферизує результати доставки і пачками записує їх у broadcast_deliveries,
+    щоб не робити окремий UPDATE на кожне повідомлення.
+    """
+
+    def __init__(self, job_id: int, batch_size: int = 200, flush_interval: float = 2.0):
+        self.job_id = job_id
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._last_flush = time.monotonic()
+
+    async def record(self, uid: int, status: str, error: Optional[str] = None):
+        self._buffer.append((uid, status, error[:500] if error else None))
+        if len(self._buffer) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            await self.flush()
+
+    async def flush(self):
+        batch, self._buffer = self._buffer, []
+        self._last_flush = time.monotonic()
+        if not batch:
+            return
+        try:
+            await save_delivery_results(self.job_id, batch, worker_id())
+        except Exception as e:
+            # Повертаємо результати в буфер, щоб записати їх при наступній спробі
+            self._buffer = batch + self._buffer
+            logging.error(f"Помилка запису журналу доставки для розсилки #{self.job_id}: {e}")
+
+    async def drain(self, attempts: int = 5, delay: float = 2.0):
+        """
+        Записує весь буфер, повторюючи при помилках БД. Якщо так і не вдалося — RuntimeError:
+        розсилку не можна позначати завершеною, поки результати надісланих повідомлень не в журналі.
+        """
+        for attempt in range(attempts):
+            await self.flush()
+            if not self._buffer:
+                return
+            await asyncio.sleep(delay * (attempt + 1))
+        raise RuntimeError(f"не вдалося записати {len(self._buffer)} результатів доставки розсилки #{self.job_id}")
+
+
+def make_broadcast_sender(job):
+    """Повертає корутину send_one(uid) для завдання розсилки з broadcast_jobs."""
+    if job['kind'] == 'text':
+        async def send_one(uid: int):
+            await bot.send_message(chat_id=uid, text=job['message_text'])
+    else:
+        async def send_one(uid: int):
+            await bot.copy_message(
+                chat_id=uid,
+                from_chat_id=job['from_chat_id'],
+                message_id=job['message_id']
+            )
+    return send_one
+
+
+# Розсилки, які цей процес виконує або вже поставив у чергу (щоб періодичний пошук не дублював їх)
+local_broadcast_jobs = set()
+# Розсилки, які цей процес відправляє просто зараз
+delivering_broadcast_jobs = set()
+
+def rebalance_bulk_rate(cluster_running: int = 0):
+    """Частка BROADCAST_RATE цього воркера: пропорційно його розсилкам серед усіх, що йдуть зараз."""
+    local = len(delivering_broadcast_jobs)
+    share = local / max(cluster_running, local) if local else 1.0
+    outbound_scheduler.set_bulk_rate(BROADCAST_RATE * share)
+
+def worker_id() -> str:
+    """Ідентифікатор процесу-власника розсилки (хост + pid)."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+async def keep_broadcast_lease(job_id: int, delivery: asyncio.Task) -> str:
+    """
+    Поки розсилка йде, періодично оновлює heartbeat, щоб інші воркери її не підхопили.
+    Скасовує доставку і повертає причину:
+    'cancelled' — адмін зупинив розсилку (/cancel_broadcast, можливо з іншого воркера);
+    'lost' — розсилку перехопили або heartbeat не вдається оновити так довго, що оренда от-от спливе
+    (інакше два воркери слали б тим самим 'pending' отримувачам).
+    """
+    interval = BROADCAST_LEASE_SECONDS / 3
+    last_renewed = time.monotonic()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            lease = await renew_broadcast_lease(job_id, worker_id())
+            if lease and lease['cancel_requested']:
+                logging.info(f"Розсилку #{job_id} скасовано адміном, зупиняю відправку.")
+                delivery.cancel()
+                return 'cancelled'
+            if lease:
+                last_renewed = time.monotonic()
+                rebalance_bulk_rate(lease['running'])
+                continue
+            logging.warning(f"Розсилку #{job_id} перехопив інший воркер, зупиняю відправку.")
+        except Exception as e:
+            logging.error(f"Не вдалося оновити heartbeat розсилки #{job_id}: {e}")
+            if time.monotonic() - last_renewed + interval < BROADCAST_LEASE_SECONDS:
+                continue
+            logging.warning(f"Оренда розсилки #{job_id} спливає без heartbeat, зупиняю відправку.")
+        delivery.cancel()
+        return 'lost'
+
+
+async def run_broadcast_job(job_id: int) -> Optional[dict]:
+    """
+    Виконує (або продовжує) завдання розсилки: надсилає тільки отримувачам зі статусом 'pending'
+    і записує результат по кожному з них у журнал доставки.
+    Спершу бере завдання у власність (owner + heartbeat); None — його веде інший воркер.
+    """
+    local_broadcast_jobs.add(job_id)
+    try:
+        job = await claim_broadcast_job(job_id, worker_id())
+        if job is None:
+            logging.info(f"Розсилку #{job_id} вже веде інший воркер, пропускаю.")
+            return None
+        if job['cancel_requested']:
+            # Скасували, поки розсилка була без живого власника (воркер упав до наступного heartbeat)
+            await finish_broadcast_job(job_id, 'cancelled')
+            logging.info(f"Розсилку #{job_id} скасовано адміном, не продовжую.")
+            return None
+        # Доставка — окрема задача, щоб heartbeat міг її зупинити; скасування цієї задачі (/cancel_job,
+        # зупинка бота) передається доставці через await
+        delivery = asyncio.create_task(deliver_broadcast_job(job))
+        heartbeat = asyncio.create_task(keep_broadcast_lease(job_id, delivery))
+        delivering_broadcast_jobs.add(job_id)
+        try:
+            return await delivery
+        except asyncio.CancelledError:
+            stopped_by = heartbeat.result() if heartbeat.done() and not heartbeat.cancelled() else None
+            if stopped_by == 'lost':
+                return None  # оренду втрачено — розсилку продовжує інший воркер
+            if stopped_by == 'cancelled':
+                await finish_broadcast_job(job_id, 'cancelled')
+                if job['admin_chat_id']:
+                    try:
+                        await bot.send_message(job['admin_chat_id'], f"⛔ Розсилку #{job_id} скасовано.")
+                    except Exception as e:
+                        logging.error(f"Не вдалося повідомити про скасування розсилки #{job_id}: {e}")
+                raise
+            # Зупинка воркера: звільняємо розсилку, щоб її одразу підхопив інший або перезапущений процес
+            await release_broadcast_job(job_id, worker_id())
+            raise
+        finally:
+            heartbeat.cancel()
+            delivering_broadcast_jobs.discard(job_id)
+            if not delivering_broadcast_jobs:
+                rebalance_bulk_rate()
+    finally:
+        local_broadcast_jobs.discard(job_id)
+
+
+async def deliver_broadcast_job(job) -> dict:
+    """Надсилає розсилку, захоплену цим воркером, і звітує адміну."""
+    job_id = job['id']
+    done = sum(cnt for status, cnt in (await get_broadcast_job_stats(job_id)).items() if status != 'pending')
+    logging.info(f"DEBUG: Розсилка #{job_id}: вже оброблено {done} отримувачів, продовжую.")
+
+    background_job = current_background_job.get()
+    if background_job:
+        background_job.broadcast_job_id = job_id
+
+    ledger = DeliveryLedger(job_id)
+
+    async def on_result(uid: int, status: str, error: Optional[str]):
+        nonlocal done
+        done += 1
+        report_progress(f"розсилка #{job_id}: оброблено {done}")
+        await ledger.record(uid, status, error)
+
+    try:
+        await run_broadcast(iter_job_recipients(job), make_broadcast_sender(job), on_result=on_result)
+    except asyncio.CancelledError:
+        await ledger.flush()
+        # Скасування адміном (/cancel_job) закриває розсилку; зупинка бота — ні, її буде продовжено після рестарту
+        if background_job and background_job.cancel_requested:
+            await finish_broadcast_job(job_id, 'cancelled')
+            logging.info(f"Розсилку #{job_id} скасовано адміном.")
+        raise
+    finally:
+        await ledger.flush()
+
+    # Розсилка 'done' лише коли журнал повний; інакше вона лишається 'running' і буде продовжена
+    await ledger.drain()
+    await finish_broadcast_job(job_id)
+    totals = await get_broadcast_job_stats(job_id)
+    sent = totals.get('sent', 0)
+    failed = totals.get('failed', 0)
+    blocked = totals.get('blocked', 0)
+
+    logging.info(f"DEBUG: Фінальні результати розсилки #{job_id}: Успіх={sent}, Помилки={failed}, Заблоковано={blocked}")
+    title = "Розсилка завершена." if job['kind'] == 'copy' else "Цільова розсилка завершена."
+    final_result = f"{title}\nУспіх: {sent}, помилки: {failed}"
+    if blocked > 0:
+        final_result += (
+            f"\nЗаблокували бота або видалили акаунт: {blocked}. "
+            "Їх виключено з наступних розсилок (список: /blocked)."
+        )
+    if job['admin_chat_id']:
+        try:
+            await bot.send_message(job['admin_chat_id'], final_result)
+        except Exception as e:
+            logging.error(f"Не вдалося надіслати звіт про розсилку #{job_id}: {e}")
+    return {'sent': sent, 'failed': failed, 'blocked': blocked}
+
+
+async def resume_unfinished_broadcasts():
+    """Продовжує розсилки, покинуті зупиненим або загиблим воркером (після рестарту чи в будь-якому воркері)."""
+    jobs = await get_unfinished_broadcast_jobs()
+    for job in jobs:
+        # Кілька воркерів можуть побачити ту саму покинуту розсилку — продовжує лише той, хто її захопив
+        if job['id'] in local_broadcast_jobs or not await claim_broadcast_job(job['id'], worker_id()):
+            continue
+        logging.info(f"Відновлюю незавершену розсилку #{job['id']}.")
+        background_job = task_executor.submit(
+            f"розсилка #{job['id']} (відновлення)",
+            lambda job_id=job['id']: run_broadcast_job(job_id),
+            owner_id=job['admin_chat_id']
+        )
+        if background_job is None:
+            logging.warning(f"Черга фонових задач переповнена, розсилку #{job['id']} продовжить інший воркер або наступна перевірка.")
+            continue
+        local_broadcast_jobs.add(job['id'])
+        if job['admin_chat_id']:
+            try:
+                await bot.send_message(job['admin_chat_id'], f"♻️ Бот перезапустився. Продовжую розсилку #{job['id']} з місця зупинки.")
+            except Exception as e:
+                logging.error(f"Не вдалося повідомити адміна про відновлення розсилки #{job['id']}: {e}")
+
+
+async def process_broadcast_message(content_chat_id: int, content_message_id: int, message: Message, broadcast_filter: str = None):
+    
+    # ❗ Аудиторія не завантажується наперед: отримувачі читаються з БД посторінково під час розсилки
+    if broadcast_filter:
+        filter_info = f"за фільтром '{broadcast_filter}'"
+    else:
+        filter_info = "усім активним користувачам"
+
+    job_id = await create_broadcast_job(
+        'copy', admin_chat_id=message.chat.id,
+        from_chat_id=content_chat_id, message_id=content_message_id, broadcast_filter=broadcast_filter
+    )
+    await message.answer(f"Починаю розсилку #{job_id} {filter_info}. Будь ласка, зачекайте.")
+
+    logging.info(f"DEBUG: Починаю розсилку #{job_id} (copy_message) {filter_info}.")
+    await run_broadcast_job(job_id)
+
+
+# --- СПОВІЩЕННЯ АДМІНІВ (паралельна розсилка повідомлень користувачів) ---
+
+# Тимчасові збої, після яких виклик Bot API варто повторити
+TRANSIENT_API_ERRORS = (TelegramNetworkError, TelegramServerError, ClientConnectorError, asyncio.TimeoutError)
+
+async def call_with_retries(make_call, chat_id: int, max_retries: int = ADMIN_NOTIFY_MAX_RETRIES):
+    """
+    Виконує один виклик Bot API (через outbound_scheduler, як і всі виклики бота), повторюючи тимчасові збої.
+    Після 429 планувальник сам стає на паузу, після мережевих/5xx помилок — коротка експоненційна затримка.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return await make_call()
+        except TelegramRetryAfter as e:
+            last_error = e
+        except TRANSIENT_API_ERRORS as e:
+            last_error = e
+            await asyncio.sleep(min(0.5 * 2 ** attempt, 5))
+        logging.warning(f"Тимчасова помилка API для чату {chat_id} (спроба {attempt + 1}): {type(last_error).__name__} - {last_error}")
+    raise last_error
+
+async def notify_admin(admin_id: int, message: Optional[Message], caption: str,
+                       bundle: Optional[tuple] = None) -> list:
+    """
+    Пересилає повідомлення користувача одному адміну (якщо message задано) і додає картку з даними.
+    bundle=(from_chat_id, [message_id, ...]) — пересилання кількох повідомлень (пачка антифлуду) через forward_messages.
+    Повертає ID усіх повідомлень, що дійшли (пересилання і картка незалежні: збій одного не скасовує іншого,
+    і на будь-яке доставлене адмін може відповісти). Виняток — лише якщо не дійшло нічого.
+    """
+    sent_ids = []
+    errors = []
+    if message is not None:
+        try:
+            forwarded = await call_with_retries(lambda: message.forward(admin_id), admin_id)
+            sent_ids.append(forwarded.message_id)
+        except Exception as e:
+            errors.append(e)
+    if bundle is not None:
+        from_chat_id, message_ids = bundle
+        # Bot API пересилає до 100 повідомлень за виклик, зберігаючи альбоми
+        for start in range(0, len(message_ids), 100):
+            chunk = message_ids[start:start + 100]
+            try:
+                forwarded = await call_with_retries(
+                    lambda: bot.forward_messages(chat_id=admin_id, from_chat_id=from_chat_id, message_ids=chunk),
+                    admin_id
+                )
+                sent_ids.extend(item.message_id for item in forwarded)
+            except Exception as e:
+                errors.append(e)
+    try:
+        card = await call_with_retries(
+            lambda: bot.send_message(chat_id=admin_id, text=caption, parse_mode='HTML'), admin_id
+        )
+        sent_ids.append(card.message_id)
+    except Exception as e:
+        errors.append(e)
+    if not sent_ids:
+        raise errors[0]
+    for error in errors:
+        logging.error(f"Адміністратор {admin_id} отримав не все сповіщення: {error}")
+    return sent_ids
+
+async def notify_admins(message: Optional[Message], caption: str, bundle: Optional[tuple] = None) -> dict:
+    """
+    Розсилає повідомлення користувача (або лише картку, якщо message=None) всім адмінам одночасно (asyncio.gather).
+    Помилка для одного адміна не заважає іншим. Повертає {admin_id: [message_id, ...]} для успішних.
+    """
+    results = await asyncio.gather(
+        *(notify_admin(admin_id, message, caption, bundle) for admin_id in ADMINS),
+        return_exceptions=True
+    )
+    delivered = {}
+    for admin_id, result in zip(ADMINS, results):
+        if isinstance(result, Exception):
+            logging.error(f"Помилка при пересиланні адміністратору {admin_id}: {result}")
+        else:
+            delivered[admin_id] = result
+    return delivered
+
+
+# --- АНТИФЛУД (вхідні повідомлення від користувачів) ---
+
+def describe_message_content(message: Message) -> str:
+    """Короткий текст повідомлення для тікета/пачки: текст, підпис або тип медіа."""
+    if message.text:
+        return message.text[:200]
+    if message.caption:
+        return f"[{message.content_type}] {message.caption[:200]}"
+    return f"[{message.content_type or 'медіа'}]"
+
+async def deliver_coalesced_messages(user_id: int, user_name: str, items: list):
+    """
+    Пачка повідомлень, затриманих антифлудом (items — [(message_id, короткий опис), ...]): один запис у тікет,
+    а кожному адміну — самі повідомлення одним forward_messages (фото, файли й повний текст) і картка-зміст.
+    """
+    message_ids = [message_id for message_id, _ in items]
+    summaries = [summary for _, summary in items]
+    await log_support_ticket(user_id, user_name, f"[{len(items)} повідомлень поспіль]\n" + "\n".join(summaries))
+
+    header = (
+        f"📦 <b>ЩЕ {len(items)} ПОВІДОМЛЕНЬ ВІД КОРИСТУВАЧА</b> (об'єднано антифлудом, оригінали переслано вище)\n"
+        f"Ім'я: <b>{escape_html(user_name)}</b>\n"
+        f"🔑 ID: <code>{user_id}</code>\n\n"
+    )
+    footer = "\n--- Щоб відповісти, <b>натисніть 'Відповісти'</b> на це повідомлення. ---"
+    body = ""
+    for i, summary in enumerate(summaries, 1):
+        line = f"{i}. {escape_html(summary[:150])}\n"
+        if len(header) + len(body) + len(line) + len(footer) > 3900:
+            body += f"... та ще {len(items) - i + 1}\n"
+            break
+        body += line
+
+    delivered = await notify_admins(None, header + body + footer, bundle=(user_id, message_ids))
+    await save_admin_message_map(user_id, delivered)
+    try:
+        await bot.send_message(user_id, "✅ Ваші повідомлення отримано. Адміністратор незабаром відповість вам.")
+    except Exception as e:
+        logging.warning(f"Не вдалося підтвердити пачку повідомлень користувачу {user_id}: {e}")
+
+
+# Кнопки reply-клавіатури, які handle_all_messages обробляє як навігацію, а не як звернення в підтримку
+MENU_BUTTON_TEXTS = ("📂 Меню", "👑 Адмін-панель")
+
+
+class InboundFloodMiddleware(BaseMiddleware):
+    """
+    Антифлуд для звичайних користувачів (dp.message, outer-middleware).
+    У кожного користувача свій токен-бакет: FLOOD_BURST повідомлень одразу, далі FLOOD_RATE за секунду.
+    Повідомлення понад ліміт не обробляються поодинці: протягом FLOOD_COALESCE_WINDOW вони збираються в пачку,
+    яка йде в тікет одним записом, а адмінам — оригіналами (forward_messages) і карткою-змістом. Команди, кнопки меню й контакти понад ліміт та все понад
+    FLOOD_MAX_BUNDLE у пачці відкидаються. Адміни не обмежуються.
+    """
+
+    def __init__(self, rate: float, burst: int, window: float, max_bundle: int):
+        self.rate = rate
+        self.burst = burst
+        self.window = window
+        self.max_bundle = max_bundle
+        self._buckets = {}   # user_id -> (токени, час останнього оновлення)
+        self._bundles = {}   # user_id -> {'user_name', 'items', 'task'}
+        self._tasks = set()  # усі _flush_later, включно з тими, що вже доставляють пачку
+
+    def _take_token(self, user_id: int) -> bool:
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1
+        self._buckets[user_id] = (tokens - 1 if allowed else tokens, now)
+        if len(self._buckets) > 10000:
+            # Бакети, що вже повністю наповнились, нічого не пам'ятають — їх можна забути
+            refill = self.burst / self.rate if self.rate > 0 else float('inf')
+            self._buckets = {uid: b for uid, b in self._buckets.items() if now - b[1] < refill}
+        return allowed
+
+    async def __call__(self, handler, event: Message, data: dict):
+        user = event.from_user
+        if user is None or user.id in ADMINS or event.chat.type != 'private':
+            return await handler(event, data)
+
+        # Керуючі повідомлення ніколи не потрапляють у пачку: вони або обробляються, або відкидаються
+        is_control = bool(event.contact) or bool(
+            event.text and (event.text.startswith('/') or event.text in MENU_BUTTON_TEXTS)
+        )
+        bundle = self._bundles.get(user.id)
+        # Поки пачка відкрита, звичайні повідомлення додаються до неї, щоб адміни бачили їх у правильному порядку
+        if bundle is None or is_control:
+            if self._take_token(user.id):
+                metrics['flood_passed'] += 1
+                return await handler(event, data)
+            if is_control:
+                metrics['flood_dropped'] += 1
+                return None
+
+        if bundle is None:
+            bundle = {
+                'user_name': user.full_name or user.username or "Невідомий користувач",
+                'items': [],
+            }
+            self._bundles[user.id] = bundle
+            bundle['task'] = asyncio.create_task(self._flush_later(user.id))
+            self._tasks.add(bundle['task'])
+            bundle['task'].add_done_callback(self._tasks.discard)
+        if len(bundle['items']) >= self.max_bundle:
+            metrics['flood_dropped'] += 1
+            return None
+        bundle['items'].append((event.message_id, describe_message_content(event)))
+        metrics['flood_coalesced'] += 1
+        return None
+
+    async def _flush_later(self, user_id: int):
+        await asyncio.sleep(self.window)
+        await self.flush(user_id)
+
+    async def flush(self, user_id: int):
+        bundle = self._bundles.pop(user_id, None)
+        if not bundle or not bundle['items']:
+            return
+        metrics['flood_bundles'] += 1
+        try:
+            await deliver_coalesced_messages(user_id, bundle['user_name'], bundle['items'])
+        except Exception as e:
+            logging.error(f"Не вдалося доставити пачку повідомлень від {user_id}: {e}")
+
+    async def flush_all(self):
+        """Під час зупинки: відправляє всі незібрані пачки, не чекаючи кінця вікна."""
+        # Пачка ще в _bundles — її задача досі чекає кінця вікна (flush забирає пачку до першого await),
+        # тож скасувати її безпечно і відправити пачку тут
+        for user_id, bundle in list(self._bundles.items()):
+            bundle['task'].cancel()
+            await self.flush(user_id)
+        # Пачки, які вже доставляються, даємо дослати
+        await asyncio.gather(*self._tasks, return_exceptions=True)
 
-    await message.answer(f"Починаю розсилку {filter_info}. Будь ласка, зачекайте.")
+    def pending_messages(self) -> int:
+        return sum(len(bundle['items']) for bundle in self._bundles.values())
 
-    sent = 0
-    failed = 0
-    logging.info(f"DEBUG: Починаю розсилку (copy_message) для {len(users)} користувачів.")
 
-    for uid in users:
-        try:
-            await asyncio.sleep(0.15)
-            await bot.copy_message(
-                chat_id=uid,
-                from_chat_id=content_chat_id,
-                message_id=content_message_id
-            )
-            sent += 1
-        except (TelegramForbiddenError, TelegramBadRequest, TelegramRetryAfter, ClientConnectorError) as e:
-            failed += 1
-            if isinstance(e, TelegramForbiddenError):
-                logging.warning(f"INFO: Користувач {uid} заблокував бота.")
+flood_middleware = InboundFloodMiddleware(FLOOD_RATE, FLOOD_BURST, FLOOD_COALESCE_WINDOW, FLOOD_MAX_BUNDLE)
+dp.message.outer_middleware(flood_middleware)
+metric_gauges['flood_pending_messages'] = flood_middleware.pending_messages
+
+
+# --- ВІДПОВІДЬ У ВЕБХУК ТА ЗАМІРИ ЧАСУ ---
+
+async def respond(method):
+    """
+    Останній (або єдиний) виклик Bot API у хендлері: `return await respond(message.answer(...))`.
+    З WEBHOOK_REPLY_MODE метод повертається як тіло відповіді на вебхук — мінус один вихідний HTTP-запит.
+    Інакше виконується звичайним викликом.
+    """
+    if WEBHOOK_REPLY_MODE:
+        metrics['webhook_inline_replies'] += 1
+        return method
+    return await method
+
+async def api_timing_middleware(make_request, bot, method):
+    """Час кожного вихідного виклику Bot API (без очікування в outbound_scheduler)."""
+    started = time.perf_counter()
+    try:
+        return await make_request(bot, method)
+    finally:
+        metrics['api_calls_total'] += 1
+        metrics['api_call_ms_total'] += (time.perf_counter() - started) * 1000
+
+async def update_timing_middleware(handler, event, data):
+    """Час обробки одного апдейту від отримання до повернення з хендлера."""
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    finally:
+        metrics['updates_total'] += 1
+        metrics['update_handle_ms_total'] += (time.perf_counter() - started) * 1000
+
+def average_api_call_ms() -> float:
+    return round(metrics['api_call_ms_total'] / metrics['api_calls_total'], 1) if metrics['api_calls_total'] else 0.0
+
+# Реєструється після outbound_scheduler, тому міряє лише сам HTTP-запит
+bot.session.middleware(api_timing_middleware)
+dp.update.outer_middleware(update_timing_middleware)
+metric_gauges['api_call_ms_avg'] = average_api_call_ms
+# ОЦІНКА (не вимір) зекономленого часу: кількість відповідей у вебхук × середній виміряний виклик API.
+# Виміряні величини — webhook_inline_replies і api_call_ms_avg; сам виклик, якого не було, виміряти неможливо.
+metric_gauges['webhook_inline_saved_ms_estimate'] = lambda: round(metrics['webhook_inline_replies'] * average_api_call_ms())
+
+
+# --- ДЕДУПЛІКАЦІЯ АПДЕЙТІВ ---
+
+class UpdateIdWindow:
+    """
+    Бітова карта останніх `size` update_id (кільцевий буфер, 1 біт на апдейт: 64К апдейтів = 8 КБ).
+    Telegram видає update_id по зростанню, але після тижня без апдейтів починає з випадкового числа.
+    Тому id далеко нижче вікна не вважається повтором: вікно починається заново з нього
+    (справжні повтори апдейтів з побічними ефектами все одно відсіче processed_updates).
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._bits = bytearray((size + 7) // 8)
+        self._highest = None
+
+    def _flip(self, update_id: int, value: bool):
+        index = update_id % self.size
+        if value:
+            self._bits[index >> 3] |= 1 << (index & 7)
+        else:
+            self._bits[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+
+    def add(self, update_id: int) -> bool:
+        """Запам'ятовує update_id. False — такий уже був у вікні."""
+        if self._highest is None:
+            self._highest = update_id
+        elif update_id > self._highest:
+            # Звільняємо біти для id, що з'явились між попереднім максимумом і новим
+            if update_id - self._highest >= self.size:
+                self._bits = bytearray(len(self._bits))
             else:
-                logging.error(f"DEBUG: Помилка при відправці користувачу {uid}: {type(e).__name__} - {e}")
-        except Exception as e:
-            failed += 1
-            logging.error(f"DEBUG: Невідома помилка при відправці користувачу {uid}: {type(e).__name__} - {e}")
+                for skipped in range(self._highest + 1, update_id + 1):
+                    self._flip(skipped, False)
+            self._highest = update_id
+        elif update_id <= self._highest - self.size:
+            self._bits = bytearray(len(self._bits))
+            self._highest = update_id
+        index = update_id % self.size
+        if self._bits[index >> 3] & (1 << (index & 7)):
+            return False
+        self._flip(update_id, True)
+        return True
+
+
+# Кнопки, натискання яких щось змінює (публікація/розсилка, видалення поста)
+SIDE_EFFECT_CALLBACK_PREFIXES = ('save_to_folder_', 'del_post_')
+
+def has_side_effects(update: Update) -> bool:
+    """Повідомлення (тікети, пересилання, відповіді, команди) і кнопки зі змінами — їх дедуплікуємо і через БД."""
+    if update.message is not None:
+        return True
+    callback = update.callback_query
+    return bool(callback and callback.data and callback.data.startswith(SIDE_EFFECT_CALLBACK_PREFIXES))
+
+
+class UpdateDedupMiddleware(BaseMiddleware):
+    """
+    Повторна доставка того ж апдейта (Telegram не дочекався відповіді на вебхук) не запускає хендлери вдруге.
+    Спершу — перевірка у вікні в пам'яті; для апдейтів з побічними ефектами ще й запис у processed_updates,
+    тож повтор після рестарту теж відсікається.
+    """
 
-    logging.info(f"DEBUG: Фінальні результати: Успіх={sent}, Помилки={failed}")
-    final_result = f"Розсилка завершена.\nУспіх: {sent}, помилки: {failed}"
-    if failed > 0:
-        final_result += "\nЗверніть увагу: усі користувачі, які заблокували бота, збережені в базі даних."
-    await message.answer(final_result)
+    def __init__(self, window: int):
+        self.window = UpdateIdWindow(window)
+
+    async def __call__(self, handler, event: Update, data: dict):
+        if not self.window.add(event.update_id):
+            metrics['dedup_dropped_memory'] += 1
+            logging.info(f"Апдейт {event.update_id} уже оброблено, пропускаю повтор.")
+            return None
+        if has_side_effects(event):
+            try:
+                if not await claim_update(event.update_id):
+                    metrics['dedup_dropped_db'] += 1
+                    logging.info(f"Апдейт {event.update_id} уже оброблено до рестарту, пропускаю повтор.")
+                    return None
+            except Exception as e:
+                # БД недоступна — краще обробити, ніж загубити повідомлення
+                logging.error(f"Не вдалося записати апдейт {event.update_id} в processed_updates: {e}")
+        return await handler(event, data)
+
+
+dp.update.outer_middleware(UpdateDedupMiddleware(DEDUP_WINDOW))
 
 
 # --- ХЕНДЛЕРИ КОМАНД (Розташовані першими) ---
@@ -552,11 +3171,9 @@ async def cmd_start(message: Message):
     username = message.from_user.username or "Unknown"
     full_name = message.from_user.full_name or "Невідоме ім'я"
     
-    global pool
-    async with pool.acquire() as conn:
-        phone = await conn.fetchval("SELECT phone_number FROM users WHERE user_id = $1", user_id)
-
-    await add_user(user_id, username, full_name, phone) 
+    # ❗ Один upsert з RETURNING: збережений телефон не затирається (COALESCE) і одразу повертається
+    profile = await add_user(user_id, username, full_name)
+    phone = profile['phone_number']
     
     if user_id in ADMINS:
         keyboard = get_admin_keyboard()
@@ -598,11 +3215,11 @@ async def cmd_start(message: Message):
 async def cmd_menu(message: Message):
     is_admin = message.from_user.id in ADMINS
     
-    await message.answer(
+    return await respond(message.answer(
         "📂 **Головне меню**\n\nОберіть розділ, який вас цікавить:",
         reply_markup=await generate_folder_keyboard(for_admin=False, is_admin_menu=is_admin),
         parse_mode='Markdown'
-    )
+    ))
 
 @dp.message(Command("savepost"))
 async def cmd_savepost(message: Message, state: FSMContext):
@@ -636,72 +3253,85 @@ async def cmd_broadcast(message: Message, state: FSMContext):
         await message.answer("❌ **Помилка:** Адміністратор не налаштував `ARCHIVE_CHANNEL_ID` у файлі .env. Розсилка неможлива.")
         return
         
+    # /broadcast <сегмент> — розсилка лише частині аудиторії (див. /segment_count)
+    parts = message.text.split(maxsplit=1)
+    broadcast_filter = parts[1].strip() if len(parts) > 1 else None
+    segment_info = ""
+    if broadcast_filter:
+        try:
+            audience = await count_audience(broadcast_filter)
+        except SegmentError as e:
+            await message.reply(f"❌ Помилка в сегменті: {escape_markdown(str(e))}\n\n{SEGMENT_HELP}", parse_mode='Markdown')
+            return
+        if audience == 0:
+            await message.reply("Під цей сегмент не підпадає жоден активний користувач. Розсилку не розпочато.")
+            return
+        segment_info = f"🎯 Сегмент: {audience} отримувачів.\n\n"
+
     # ❗ ФІКС: ЖОРСТКЕ ОЧИЩЕННЯ СТАНУ ПЕРЕД ПОЧАТКОМ ❗
     await state.clear() 
     
     await state.set_state(BroadcastStates.waiting_for_content)
-    await state.update_data(is_silent_mode=False) # ЯВНО ВИМИКАЄМО ТИХИЙ РЕЖИМ
+    await state.update_data(is_silent_mode=False, broadcast_filter=broadcast_filter) # ЯВНО ВИМИКАЄМО ТИХИЙ РЕЖИМ
     
     await message.answer(
+        segment_info +
         "Будь ласка, надішліть **будь-який контент** для розсилки (текст, фото, опитування тощо).\n\n"
         "Текст або підпис до медіа буде використано як **заголовок** для цього поста в 'Меню'.\n\n"
         "Або /cancel для відміни."
     )
 
-@dp.message(lambda message: message.text and message.text.lower().strip() == '/check_db')
-async def cmd_check_db(message: Message):
+@dp.message(Command("segment_count"))
+async def cmd_segment_count(message: Message):
+    """Пробний прогін сегмента: розмір аудиторії та орієнтовний час розсилки, нічого не надсилаючи."""
     if message.from_user.id not in ADMINS:
         await message.reply("У вас немає прав адміністратора для цієї команди.")
         return
-    
-    global pool
-    async with pool.acquire() as conn:
-        results = await conn.fetch("SELECT user_id, username, full_name, phone_number FROM users")
-    
-    total_count = len(results)
-    if total_count == 0:
-        await message.reply("База даних порожня. Записів не знайдено.")
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        await message.reply(f"Вкажіть вираз сегмента. Приклад: `/segment_count tag:км_535 AND has_phone`\n\n{SEGMENT_HELP}", parse_mode='Markdown')
         return
-        
-    response = f"**Звіт по базі даних `users`:**\n\nУСЬОГО ЗАПИСІВ: **{total_count}**\n============================\n"
-    for i, row in enumerate(results):
-        safe_full_name = escape_markdown(row['full_name'])
-        safe_username = escape_markdown(row['username'] or 'НЕМАЄ')
-        phone_display = row['phone_number'] or 'НЕМАЄ'
-        
-        if len(response) + 300 > 4096 and i < total_count - 1: 
-            response += f"... (та ще {total_count - i} записів)"
-            break
-        response += (
-            f"🔑 ID: `{row['user_id']}`\n👤 Ім'я: **{safe_full_name}**\n📞 Телефон: `{phone_display}`\n🆔 Username: @{safe_username}\n----------------------------\n"
-        )
-    await message.reply(response, parse_mode='Markdown')
+    try:
+        audience = await count_audience(parts[1].strip())
+    except SegmentError as e:
+        await message.reply(f"❌ Помилка в сегменті: {escape_markdown(str(e))}\n\n{SEGMENT_HELP}", parse_mode='Markdown')
+        return
+    await message.reply(
+        f"👥 Активних користувачів у сегменті: {audience}\n"
+        f"⏱ Орієнтовний час розсилки: ~{estimate_broadcast_duration(audience)} (ліміт {effective_broadcast_rate():g} повідомлень/с)\n\n"
+        f"Розіслати цьому сегменту: /broadcast {parts[1].strip()}"
+    )
+
+@dp.message(lambda message: message.text and message.text.lower().strip() == '/check_db')
+async def cmd_check_db(message: Message, state: FSMContext):
+    if message.from_user.id not in ADMINS:
+        await message.reply("У вас немає прав адміністратора для цієї команди.")
+        return
+    return await send_listing_page(message, 'users', state)
 
 @dp.message(Command("check_tickets"))
-async def cmd_check_tickets(message: Message):
+async def cmd_check_tickets(message: Message, state: FSMContext):
     if message.from_user.id not in ADMINS:
         await message.reply("У вас немає прав адміністратора для цієї команди.")
         return
+    return await send_listing_page(message, 'tickets', state)
 
-    tickets = await get_open_tickets()
-    
-    if not tickets:
-        await message.answer("✅ Чудова робота! Усі тікети закриті. Повідомлень без відповіді немає.")
+@dp.callback_query(F.data.startswith('pg:'))
+async def handle_listing_page_click(callback: CallbackQuery, state: FSMContext):
+    """◀️/▶️ у пагінованих адмін-списках."""
+    if callback.from_user.id not in ADMINS:
+        await callback.answer("Недостатньо прав.", show_alert=True)
         return
-        
-    response = f"📢 **ВІДКРИТІ ТІКЕТИ ({len(tickets)}):**\n\n"
-    for ticket in tickets:
-        safe_name = escape_html(ticket['user_name'])
-        safe_text = escape_html(ticket['message_text'][:100] + '...') 
-        
-        response += (
-            f"👤 <b>{safe_name}</b> (ID: <code>{ticket['user_id']}</code>)\n"
-            f"<i>{ticket['created_at'].strftime('%Y-%m-%d %H:%M')}</i>\n"
-            f"💬 {safe_text}\n"
-            "--------------------\n"
-        )
-    
-    await message.answer(response, parse_mode='HTML')
+    try:
+        _, listing, direction, cursor = callback.data.split(':', 3)
+        cursor = int(cursor)
+    except ValueError:
+        await callback.answer("Некоректна кнопка.", show_alert=True)
+        return
+    if listing not in ADMIN_LISTINGS:
+        await callback.answer("Цей список більше не підтримується.", show_alert=True)
+        return
+    return await send_listing_page(callback, listing, state, 'prev' if direction == 'p' else 'next', cursor)
 
 @dp.message(Command("delete_user"))
 async def cmd_delete_user(message: Message):
@@ -790,7 +3420,7 @@ async def cmd_delete_post(message: Message):
         await message.reply(f"❌ Помилка: Пост з назвою '{post_title}' не знайдено.")
 
 @dp.message(Command("find_user"))
-async def cmd_find_user(message: Message):
+async def cmd_find_user(message: Message, state: FSMContext):
     if message.from_user.id not in ADMINS:
         await message.reply("У вас немає прав адміністратора для цієї команди.")
         return
@@ -798,65 +3428,60 @@ async def cmd_find_user(message: Message):
     if len(parts) < 2:
         await message.reply("Вкажіть частину імені, username або номер телефону для пошуку. Приклад: /find_user 38067")
         return
-    query = parts[1].strip()
-    
-    global pool
-    async with pool.acquire() as conn:
-        results = await conn.fetch(
-            "SELECT user_id, username, full_name, phone_number FROM users WHERE full_name LIKE $1 OR username LIKE $1 OR phone_number LIKE $1",
-            '%' + query + '%'
-        )
-        
-    if not results:
-        await message.reply(f"Користувачів, які містять '{query}', не знайдено.")
-        return
-    response = f"**Знайдено {len(results)} користувачів за запитом '{query}':**\n\n"
-    for i, row in enumerate(results):
-        safe_full_name = escape_markdown(row['full_name'])
-        safe_username = escape_markdown(row['username'] or 'no_username')
-        phone_display = row['phone_number'] or 'немає'
-        user_info = f"👤 **{safe_full_name}** ({safe_username})\n"
-        user_info += f"📞 Телефон: `{phone_display}`\n" 
-        user_info += f"🔑 ID: `{row['user_id']}`\n"
-        if len(response) + len(user_info) > 4000 and i < len(results) - 1:
-             response += f"... (та ще {len(results) - i} записів)"
-             break
-        response += user_info + "--------------------------\n"
-    await message.reply(response, parse_mode='Markdown')
+    # Запит потрібен і для наступних сторінок (кнопки ◀️/▶️)
+    await state.update_data(find_user_query=parts[1].strip())
+    return await send_listing_page(message, 'find', state)
 
 @dp.message(Command("export_csv"))
 async def cmd_export_csv(message: Message):
     if message.from_user.id not in ADMINS:
         await message.reply("У вас немає прав адміністратора для цієї команди.")
         return
-    await message.answer("Починаю експорт даних...")
-    
-    global pool
-    async with pool.acquire() as conn:
-        results = await conn.fetch("SELECT user_id, username, full_name, phone_number FROM users")
-        
-    if not results:
-        await message.answer("База даних порожня. Немає чого експортувати.")
+    try:
+        dataset, columns, compression = parse_export_args(message.text.split()[1:])
+    except ValueError as e:
+        await message.reply(f"❌ {e}\n\nФормат: /export_csv [users|posts|tickets|ticket_messages|broadcasts] [колонка1,колонка2] [gz|zip]")
         return
-    csv_buffer = io.StringIO()
-    csv_writer = csv.writer(csv_buffer, delimiter=';', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-    headers = ['ID', 'Username', "Full Name", 'Phone Number']
-    csv_writer.writerow(headers)
-    
-    for row in results:
-        csv_writer.writerow([row['user_id'], row['username'], row['full_name'], row['phone_number']])
-        
-    csv_buffer.seek(0)
+    await submit_admin_job(
+        message, f"експорт {dataset}",
+        lambda: export_dataset_csv(message, dataset, columns, compression)
+    )
+
+@dp.message(Command("import_csv"))
+async def cmd_import_csv(message: Message, state: FSMContext):
+    if message.from_user.id not in ADMINS:
+        await message.reply("У вас немає прав адміністратора для цієї команди.")
+        return
+    await state.clear()
+    await state.set_state(ImportStates.waiting_for_file)
+    await message.answer(
+        "Надішліть .csv файл з користувачами (до 20 МБ, UTF-8, роздільник ';' або ',').\n"
+        f"Перший рядок — заголовок. Обов'язкова колонка user_id, необов'язкові: {', '.join(IMPORT_USER_COLUMNS[1:])} "
+        "(мітки — через кому). Інші колонки ігноруються, тож підходить і файл з /export_csv.\n\n"
+        "Наявних користувачів буде оновлено (порожні значення не затирають збережені). Або /cancel для відміни."
+    )
+
+async def export_dataset_csv(message: Message, dataset: str, columns: list, compression: Optional[str]):
+    await message.answer(f"Починаю експорт даних ({dataset})...")
+
+    csv_name = f"{dataset}_export.csv"
+    filename = csv_name + {'gz': '.gz', 'zip': '.zip'}.get(compression, '')
+    fd, path = tempfile.mkstemp(suffix='_' + filename)
+    os.close(fd)
     try:
+        rows = await export_query_to_file(build_export_query(dataset, columns), path, compression, csv_name)
+        if rows == 0:
+            await message.answer("Таблиця порожня. Немає чого експортувати.")
+            return
         await message.reply_document(
-            document=types.BufferedInputFile(
-                file=csv_buffer.getvalue().encode('utf-8'),
-                filename='users_export.csv'
-            ),
-            caption=f"✅ Експортовано {len(results)} записів."
+            document=FSInputFile(path, filename=filename),
+            caption=f"✅ Експортовано {rows} записів ({dataset}: {', '.join(columns)})."
         )
     except Exception as e:
-        await message.answer(f"❌ Помилка при відправці файлу: {e}")
+        await message.answer(f"❌ Помилка під час експорту: {e}")
+    finally:
+        with contextlib.suppress(OSError):
+            os.remove(path)
 
 @dp.message(Command("send_to_user"))
 async def cmd_send_to_user(message: Message):
@@ -892,8 +3517,9 @@ async def cmd_send_to_user(message: Message):
     try:
         await bot.send_message(chat_id=target_user_id, text=text_to_send)
         await message.reply(f"Повідомлення **успішно** надіслано користувачу з ID: `{target_user_id}` (знайдено за '{identifier}')", parse_mode='Markdown')
-    except TelegramForbiddenError:
-        await message.reply(f"Помилка: Користувач з ID `{target_user_id}` **заблокував бота**. Він не був видалений з бази даних.", parse_mode='Markdown')
+    except TelegramForbiddenError as e:
+        await mark_user_unreachable(target_user_id, str(e))
+        await message.reply(f"Помилка: Користувач з ID `{target_user_id}` **заблокував бота**. Його виключено з розсилок (список: /blocked).", parse_mode='Markdown')
     except Exception as e:
         await message.reply(f"Помилка при відправці користувачу `{target_user_id}`: {e}")
 
@@ -941,25 +3567,12 @@ async def cmd_send_segment(message: Message):
         await message.reply(f"Не знайдено жодного користувача за вказаними {len(identifiers)} ідентифікаторами.")
         return
     
-    await message.answer(f"Починаю цільову розсилку для **{len(target_uids)}** користувачів. Будь ласка, зачекайте.", parse_mode='Markdown')
-    sent = 0
-    failed = 0
-    for uid in target_uids:
-        try:
-            await asyncio.sleep(0.15)
-            await bot.send_message(chat_id=uid, text=text_to_send)
-            sent += 1
-        except TelegramForbiddenError:
-            failed += 1
-            logging.warning(f"INFO: Користувач {uid} заблокував бота.")
-        except Exception as e:
-            failed += 1
-            logging.error(f"DEBUG: Помилка при відправці користувачу {uid}: {type(e).__name__}.") 
-            
-    final_result = f"Цільова розсилка завершена.\nУспіх: {sent}, помилки: {failed}\n"
-    if failed > 0:
-        final_result += "Зверніть увагу: користувачі, які заблокували бота, залишені у базі даних."
-    await message.answer(final_result)
+    async def run_segment():
+        job_id = await create_broadcast_job('text', admin_chat_id=message.chat.id, user_ids=target_uids, message_text=text_to_send)
+        await message.answer(f"Починаю цільову розсилку #{job_id} для **{len(target_uids)}** користувачів. Будь ласка, зачекайте.", parse_mode='Markdown')
+        await run_broadcast_job(job_id)
+
+    await submit_admin_job(message, f"цільова розсилка ({len(target_uids)})", run_segment)
 
 @dp.message(Command("delete_segment"))
 async def cmd_delete_segment(message: Message):
@@ -986,17 +3599,132 @@ async def cmd_delete_segment(message: Message):
         await message.reply("Не вдалося розпізнати список ідентифікаторів. Переконайтесь, що вони написані через пробіл.")
         return
 
-    try:
-        deleted_count = await delete_users_by_list(identifiers)
-        
-        if deleted_count > 0:
-            await message.reply(f"✅ Успішно видалено **{deleted_count}** користувач(а/ів) з бази даних.", parse_mode='Markdown')
-        else:
-            await message.reply(f"Не знайдено жодного користувача за вказаними ідентифікаторами.")
+    async def run_delete_segment():
+        try:
+            deleted_count = await delete_users_by_list(identifiers)
             
-    except Exception as e:
-        logging.error(f"Помилка при виконанні /delete_segment: {e}")
-        await message.reply(f"❌ Сталася помилка: {e}")
+            if deleted_count > 0:
+                await message.reply(f"✅ Успішно видалено **{deleted_count}** користувач(а/ів) з бази даних.", parse_mode='Markdown')
+            else:
+                await message.reply(f"Не знайдено жодного користувача за вказаними ідентифікаторами.")
+                
+        except Exception as e:
+            logging.error(f"Помилка при виконанні /delete_segment: {e}")
+            await message.reply(f"❌ Сталася помилка: {e}")
+
+    await submit_admin_job(message, f"видалення сегмента ({len(identifiers)})", run_delete_segment)
+
+
+@dp.message(Command("blocked"))
+async def cmd_blocked(message: Message):
+    if message.from_user.id not in ADMINS:
+        await message.reply("У вас немає прав адміністратора для цієї команди.")
+        return
+
+    parts = message.text.split(maxsplit=1)
+    if len(parts) > 1 and parts[1].strip().lower() == 'purge':
+        deleted_count = await purge_inactive_users()
+        await message.reply(f"🗑️ Видалено з бази {deleted_count} користувачів, які заблокували бота або видалили акаунт.")
+        return
+
+    total, rows = await get_inactive_users()
+    if total == 0:
+        await message.reply("✅ Заблокованих або видалених користувачів немає.")
+        return
+
+    response = f"<b>Заблокували бота / видалили акаунт: {total}</b>\n(вони не отримують розсилок)\n\n"
+    for row in rows:
+        blocked_at = row['blocked_at'].strftime('%Y-%m-%d') if row['blocked_at'] else '—'
+        response += (
+            f"🔑 <code>{row['user_id']}</code> {escape_html(row['full_name'])} "
+            f"(@{escape_html(row['username'] or 'НЕМАЄ')}) — {row['status']}, {blocked_at}\n"
+        )
+    if total > len(rows):
+        response += f"... (та ще {total - len(rows)} записів)\n"
+    response += "\nВидалити їх усіх з бази: /blocked purge"
+    await message.answer(response, parse_mode='HTML')
+
+@dp.message(Command("jobs"))
+async def cmd_jobs(message: Message):
+    if message.from_user.id not in ADMINS:
+        await message.reply("У вас немає прав адміністратора для цієї команди.")
+        return
+
+    jobs = task_executor.list_jobs() if task_executor else []
+    # Задачі вище живуть у пам'яті цього воркера; розсилки — спільні для всіх, тому беремо їх з БД
+    broadcasts = await get_running_broadcast_jobs()
+    if not jobs and not broadcasts:
+        await message.answer("Фонових задач немає.")
+        return
+
+    state_icons = {'queued': '🕓', 'running': '▶️', 'done': '✅', 'failed': '❌', 'cancelled': '⛔'}
+    now = time.monotonic()
+    response = ""
+    if jobs:
+        response += f"<b>Фонові задачі (воркер {escape_html(worker_id())}):</b>\n\n"
+        for job in reversed(jobs[-20:]):
+            started = job.started_at or now
+            elapsed = int((job.finished_at or now) - started)
+            line = f"{state_icons.get(job.state, '')} #{job.id} {escape_html(job.title)} — {job.state}, {elapsed}с"
+            if job.progress:
+                line += f"\n    {escape_html(job.progress)}"
+            response += line + "\n"
+        response += "\nСкасувати: /cancel_job [номер]\n\n"
+    if broadcasts:
+        response += "<b>Розсилки (усі воркери):</b>\n\n"
+        for b in broadcasts:
+            total = f"{b['total']}" if b['audience_complete'] else f"{b['total']}+"
+            line = f"▶️ Розсилка #{b['id']} ({b['kind']}) — оброблено {b['done']} з {total}"
+            if b['cancel_requested']:
+                line += ", скасовується"
+            if b['owner'] and b['heartbeat_age'] is not None:
+                line += f"\n    воркер {escape_html(b['owner'])}, heartbeat {b['heartbeat_age']}с тому"
+            else:
+                line += "\n    очікує вільного воркера"
+            response += line + "\n"
+        response += "\nЗупинити розсилку: /cancel_broadcast [номер]"
+    await message.answer(response.strip(), parse_mode='HTML')
+
+@dp.message(Command("cancel_job"))
+async def cmd_cancel_job(message: Message):
+    if message.from_user.id not in ADMINS:
+        await message.reply("У вас немає прав адміністратора для цієї команди.")
+        return
+
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2 or not parts[1].strip().lstrip('#').isdigit():
+        await message.reply("Вкажіть номер задачі. Приклад: /cancel_job 3\nСписок задач: /jobs")
+        return
+
+    job_id = int(parts[1].strip().lstrip('#'))
+    if task_executor and task_executor.cancel(job_id):
+        await message.reply(f"⛔ Задачу #{job_id} скасовано.")
+    else:
+        await message.reply(f"❌ Активну задачу #{job_id} не знайдено.")
+
+@dp.message(Command("cancel_broadcast"))
+async def cmd_cancel_broadcast(message: Message):
+    """Зупиняє розсилку з broadcast_jobs, хоч би який воркер її вів."""
+    if message.from_user.id not in ADMINS:
+        await message.reply("У вас немає прав адміністратора для цієї команди.")
+        return
+
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2 or not parts[1].strip().lstrip('#').isdigit():
+        await message.reply("Вкажіть номер розсилки. Приклад: /cancel_broadcast 12\nСписок розсилок: /jobs")
+        return
+
+    job_id = int(parts[1].strip().lstrip('#'))
+    status = await request_broadcast_cancel(job_id)
+    if status is None:
+        await message.reply(f"❌ Активну розсилку #{job_id} не знайдено.")
+    elif status == 'cancelled':
+        await message.reply(f"⛔ Розсилку #{job_id} скасовано.")
+    else:
+        await message.reply(
+            f"⏳ Розсилку #{job_id} буде зупинено протягом ~{int(BROADCAST_LEASE_SECONDS / 3)} с "
+            "(воркер, що її веде, перевіряє запит під час heartbeat)."
+        )
 
 
 # --- ХЕНДЛЕРИ FSM (Машини станів) ДЛЯ РОЗСИЛКИ ---
@@ -1132,11 +3860,16 @@ async def handle_broadcast_folder(callback: CallbackQuery, state: FSMContext):
     if not is_silent_mode:
         await callback.message.edit_text(message_response + "Починаю розсилку...")
         # ❗ РОЗСИЛКА ТАКОЖ ВИКОРИСТОВУЄ forward_message (через process_broadcast_message)
-        await process_broadcast_message(
-            content_chat_id=ARCHIVE_CHANNEL_ID,
-            content_message_id=archive_message_id, # ID з архіву
-            message=callback.message,
-            broadcast_filter=None
+        # ❗ Розсилка йде у фоні, щоб не тримати запит вебхука відкритим
+        await submit_admin_job(
+            callback.message,
+            "розсилка",
+            lambda: process_broadcast_message(
+                content_chat_id=ARCHIVE_CHANNEL_ID,
+                content_message_id=archive_message_id, # ID з архіву
+                message=callback.message,
+                broadcast_filter=user_data.get('broadcast_filter')
+            )
         )
     else:
         # Відповідь для адміна, якщо активовано Тихий режим
@@ -1146,26 +3879,49 @@ async def handle_broadcast_folder(callback: CallbackQuery, state: FSMContext):
     await state.clear()
 
 
-# --- ХЕНДЛЕРИ ДЛЯ ПЕРЕГЛЯДУ ПАПОК (НОВА ЛОГІКА) ---
+@dp.message(ImportStates.waiting_for_file, F.document)
+async def handle_import_file(message: Message, state: FSMContext):
+    """Отримує .csv для /import_csv і запускає імпорт у фоні."""
+    document = message.document
+    if document.file_size and document.file_size > IMPORT_MAX_FILE_SIZE:
+        await message.answer("Файл завеликий (максимум 20 МБ). Розбийте його на частини або /cancel.")
+        return
+    await state.clear()
+    await submit_admin_job(message, "імпорт CSV", lambda: run_users_import(message, document))
 
-# ❗❗❗ ФІКС NAMEERROR: Потрібно визначити get_all_posts_by_folder, якщо вона не визначена вище ❗❗❗
-# Я включаю її сюди, щоб вона гарантовано була доступна для show_folder_contents.
-# Якщо ця функція вже була визначена у розділі БД, просто видаліть її звідти, 
-# або не вставляйте цей дублікат, але тоді виправте порядок у вашому файлі.
-async def get_all_posts_by_folder(folder_id: int):
-    global pool
-    async with pool.acquire() as conn:
-        posts = await conn.fetch(
-            "SELECT id, post_title, message_id FROM posts WHERE folder_id = $1 ORDER BY created_at ASC",
-            folder_id
+async def run_users_import(message: Message, document: types.Document):
+    fd, path = tempfile.mkstemp(suffix='_import.csv')
+    os.close(fd)
+    try:
+        await bot.download(document, destination=path)
+        started = time.monotonic()
+        result = await import_users_from_csv(path)
+        await message.answer(
+            f"✅ Імпорт завершено за {time.monotonic() - started:.1f} с.\n"
+            f"Додано: {result['inserted']}, оновлено: {result['updated']}, "
+            f"відхилено: {result['rejected']} (порожній/некоректний user_id або повтор у файлі)."
         )
-    return posts 
-# ❗❗❗ КІНЕЦЬ: get_all_posts_by_folder ❗❗❗
-# ----------------------------------------------------------------------------------------------------
+    except ValueError as e:
+        await message.answer(f"❌ {e}")
+    except asyncpg.exceptions.DataError as e:
+        await message.answer(f"❌ Файл не вдалося прочитати як CSV: {e}")
+    except Exception as e:
+        logging.error(f"Помилка імпорту CSV: {e}")
+        await message.answer(f"❌ Помилка під час імпорту: {e}")
+    finally:
+        with contextlib.suppress(OSError):
+            os.remove(path)
+
+@dp.message(ImportStates.waiting_for_file)
+async def handle_import_invalid(message: Message):
+    await message.answer("Очікую .csv файл документом. Або /cancel для відміни.")
+
 
+# --- ХЕНДЛЕРИ ДЛЯ ПЕРЕГЛЯДУ ПАПОК (НОВА ЛОГІКА) ---
 
-async def show_folder_contents(target: types.Message | types.CallbackQuery, folder_id: int, is_admin: bool = False):
-    """Відображає список кнопок (постів) у папці."""
+async def show_folder_contents(target: types.Message | types.CallbackQuery, folder_id: int, is_admin: bool = False,
+                               direction: str = 'next', cursor: Optional[str] = None):
+    """Відображає одну сторінку кнопок (постів) у папці."""
     
     # Додавання global pool для надійності, хоча функція викликає іншу, що має global pool
     global pool 
@@ -1176,7 +3932,7 @@ async def show_folder_contents(target: types.Message | types.CallbackQuery, fold
         if isinstance(target, types.CallbackQuery): await target.answer()
         return
         
-    posts = await get_all_posts_by_folder(folder_id) 
+    posts, has_prev, has_next = await get_folder_posts_page(folder_id, direction, cursor)
     
     if not posts:
         text = "Ця папка поки порожня."
@@ -1185,14 +3941,14 @@ async def show_folder_contents(target: types.Message | types.CallbackQuery, fold
         ])
     else:
         text = "<b>Ось матеріали з цього розділу:</b>\n\nНатисніть на пост, щоб переглянути його."
-        markup = generate_posts_list_keyboard(posts, is_admin)
+        markup = generate_posts_list_keyboard(posts, is_admin, folder_id, has_prev, has_next)
             
     try:
         if isinstance(target, types.CallbackQuery):
             await target.message.edit_text(text, reply_markup=markup, parse_mode='HTML')
-            await target.answer()
+            return await respond(target.answer())
         else:
-            await target.answer(text, reply_markup=markup, parse_mode='HTML')
+            return await respond(target.answer(text, reply_markup=markup, parse_mode='HTML'))
     except Exception as e:
         logging.error(f"Помилка відображення списку папки: {e}")
         if isinstance(target, types.CallbackQuery): await target.answer("Помилка відображення.")
@@ -1202,13 +3958,27 @@ async def handle_folder_click(callback: CallbackQuery, state: FSMContext):
     """Користувач натиснув на кнопку папки з /menu."""
     folder_id = int(callback.data.split('_')[-1])
     is_admin = callback.from_user.id in ADMINS
-    await show_folder_contents(callback, folder_id, is_admin=is_admin)
+    return await show_folder_contents(callback, folder_id, is_admin=is_admin)
 
 @dp.callback_query(F.data.startswith('admin_folder_'))
 async def handle_admin_folder_click(callback: CallbackQuery, state: FSMContext):
     """Адмін натиснув на кнопку папки з /menu (отримує кнопки видалення)."""
     folder_id = int(callback.data.split('_')[-1])
-    await show_folder_contents(callback, folder_id, is_admin=True)
+    return await show_folder_contents(callback, folder_id, is_admin=True)
+
+@dp.callback_query(F.data.startswith('fpage_'))
+async def handle_folder_page_click(callback: CallbackQuery):
+    """Перехід на попередню/наступну сторінку постів у папці."""
+    payload = callback.data.split('_', 1)[1]
+    if not payload.startswith(('a_', 'u_')):
+        payload = 'u_' + payload  # кнопки, надіслані до появи режиму в callback_data
+    mode, folder_id, direction, cursor = payload.split('_', 3)
+    # Кнопки видалення — лише якщо їх мала перша сторінка і це досі адмін
+    is_admin = mode == 'a' and callback.from_user.id in ADMINS
+    return await show_folder_contents(
+        callback, int(folder_id), is_admin=is_admin,
+        direction='prev' if direction == 'p' else 'next', cursor=cursor
+    )
 
 @dp.callback_query(F.data.startswith('view_post_'))
 async def handle_view_post_click(callback: CallbackQuery):
@@ -1225,7 +3995,7 @@ async def handle_view_post_click(callback: CallbackQuery):
             from_chat_id=ARCHIVE_CHANNEL_ID,
             message_id=message_id
         )
-        await callback.answer()
+        return await respond(callback.answer())
     except Exception as e:
         logging.error(f"Не вдалося скопіювати пост {message_id} з архіву: {e}")
         await callback.answer(f"Помилка: Не вдалося завантажити цей пост. Можливо, його було видалено з архіву.", show_alert=True)
@@ -1263,12 +4033,12 @@ async def handle_back_to_menu(callback: CallbackQuery):
         reply_markup=await generate_folder_keyboard(for_admin=False, is_admin_menu=is_admin),
         parse_mode='Markdown'
     )
-    await callback.answer()
+    return await respond(callback.answer())
 
 @dp.callback_query(F.data == 'ignore')
 async def handle_ignore_click(callback: CallbackQuery):
     """Ігноруємо натискання на неактивні кнопки."""
-    await callback.answer()
+    return await respond(callback.answer())
 
 
 # --- ФІНАЛЬНИЙ УНІВЕРСАЛЬНИЙ ХЕНДЛЕР (обробляє всі не-команди) ---
@@ -1295,11 +4065,8 @@ async def handle_all_messages(message: Message, state: FSMContext):
         user_id = message.from_user.id
         phone = message.contact.phone_number
         
-        async with pool.acquire() as conn:
-            user_data = await conn.fetchrow("SELECT username, full_name FROM users WHERE user_id = $1", user_id)
-        
-        username = user_data['username'] if user_data else "Unknown"
-        full_name = user_data['full_name'] if user_data else "Невідоме ім'я"
+        username = message.from_user.username or "Unknown"
+        full_name = message.from_user.full_name or "Невідоме ім'я"
         
         await add_user(user_id, username, full_name, phone)
         
@@ -1328,7 +4095,7 @@ async def handle_all_messages(message: Message, state: FSMContext):
         reply_message = message.reply_to_message
         logging.info("Адмін відповідає. Аналізуємо повідомлення...")
 
-        target_user_id = extract_user_id_from_reply(reply_message)
+        target_user_id = await resolve_reply_target(reply_message)
 
         tag_action = None
         tag_value = None
@@ -1337,65 +4104,35 @@ async def handle_all_messages(message: Message, state: FSMContext):
         if message.text:
             first_token = message.text.split(maxsplit=1)[0].lower()
             
-            if first_token.startswith('#tag_'):
-                tag_action = 'add'
-                tag_value = first_token.strip('#tag_').strip()
-            elif first_token.startswith('#del_'):
-                tag_action = 'del'
-                tag_value = first_token.strip('#del_').strip()
-            elif first_token.startswith('#set_'):
-                tag_action = 'set'
-                tag_value = first_token.strip('#set_').strip()
+            for prefix, action in (('#tag_', 'add'), ('#del_', 'del'), ('#set_', 'set')):
+                if first_token.startswith(prefix):
+                    tag_action = action
+                    tag_value = first_token[len(prefix):].strip()
+                    break
 
             # Очищуємо текст відповіді (для відправки користувачу)
             if tag_action:
                 parts = message.text.split(maxsplit=1)
                 clean_response_text = parts[1] if len(parts) > 1 else "" 
                 
-        # 3. ВИКОНАННЯ ДІЇ З МІТКОЮ В БД
+        # 3. ВИКОНАННЯ ДІЇ З МІТКОЮ В БД (один атомарний UPDATE)
         if target_user_id and tag_action:
-            log_message = ""
             try:
-                async with pool.acquire() as conn:
-                    current_tags_str = await conn.fetchval("SELECT tags FROM users WHERE user_id = $1", target_user_id) or ""
-                    current_tags = [t.strip() for t in current_tags_str.split(',') if t.strip()]
-                    
-                    new_tags = []
-                    
-                    if tag_action == 'add':
-                        if tag_value and tag_value not in current_tags:
-                            current_tags.append(tag_value)
-                            log_message = f"Додано мітку: '{tag_value}'."
-                        else:
-                            log_message = f"Мітка '{tag_value}' вже існує або порожня. Дія ADD пропущена."
-                        new_tags = current_tags
-                        
+                if tag_action in ('add', 'del') and not tag_value:
+                    log_message = f"Порожня мітка. Дія {tag_action.upper()} пропущена."
+                else:
+                    new_tags = await update_user_tags(target_user_id, tag_action, tag_value)
+                    if new_tags is None:
+                        log_message = f"Мітка '{tag_value}' вже існує або не знайдена. Дія {tag_action.upper()} пропущена."
+                    elif tag_action == 'add':
+                        log_message = f"Додано мітку: '{tag_value}'."
                     elif tag_action == 'del':
-                        if tag_value and tag_value in current_tags:
-                            new_tags = [t for t in current_tags if t != tag_value]
-                            log_message = f"Видалено мітку: '{tag_value}'."
-                        else:
-                            new_tags = current_tags
-                            log_message = f"Мітка '{tag_value}' не знайдена. Дія DEL пропущена."
-                            
-                    elif tag_action == 'set':
-                        # Якщо tag_value порожній (наприклад, '#set_'), це очищення
-                        if not tag_value:
-                            new_tags = []
-                            log_message = "Усі мітки очищено."
-                        else:
-                            # Заміна всіх міток на нову
-                            new_tags = [tag_value]
-                            log_message = f"Мітка змінена на: '{tag_value}' (Усі старі видалено)."
-
-                    # Зберігаємо оновлений список
-                    new_tags_str = ",".join(new_tags)
-                    await conn.execute(
-                        "UPDATE users SET tags = $1 WHERE user_id = $2",
-                        new_tags_str,
-                        target_user_id
-                    )
-                    logging.info(f"Тегування користувача {target_user_id}. {log_message}")
+                        log_message = f"Видалено мітку: '{tag_value}'."
+                    elif tag_value:
+                        log_message = f"Мітка змінена на: '{tag_value}' (Усі старі видалено)."
+                    else:
+                        log_message = "Усі мітки очищено."
+                logging.info(f"Тегування користувача {target_user_id}. {log_message}")
                     
             except Exception as e:
                 logging.error(f"Помилка при керуванні мітками для {target_user_id}: {e}")
@@ -1423,7 +4160,8 @@ async def handle_all_messages(message: Message, state: FSMContext):
                 await close_support_ticket(target_user_id, admin_id)
                 return
                 
-            except TelegramForbiddenError:
+            except TelegramForbiddenError as e:
+                await mark_user_unreachable(target_user_id, str(e))
                 await message.answer(f"❌ Помилка: Користувач з ID <code>{target_user_id}</code> заблокував бота.", parse_mode='HTML')
                 return
             except Exception as e:
@@ -1466,11 +4204,18 @@ async def handle_all_messages(message: Message, state: FSMContext):
 `/find_user [Запит]` - Знайти користувача.
 `/delete_user [ID або Тел.]` - **(ОНОВЛЕНО)** Видалити користувача.
 `/delete_segment [Список ID/Тел.]` - Видалити групу користувачів.
-`/export_csv` - Отримати .csv файл з базою.
+`/export_csv [users|posts|tickets|ticket_messages|broadcasts] [колонки] [gz|zip]` - Експорт у .csv (напр. `/export_csv users user_id,phone_number,tags gz`).
+`/import_csv` - Масово додати/оновити користувачів з .csv файлу.
+`/blocked` - Хто заблокував бота (`/blocked purge` - видалити їх з бази).
+`/jobs` - Статус фонових задач (розсилки, експорт, видалення).
+`/cancel_job [Номер]` - Скасувати фонову задачу цього воркера.
+`/cancel_broadcast [Номер]` - Зупинити розсилку (з будь-якого воркера).
 
 **Цільові Розсилки:**
 `/send_to_user [ID або Тел.] [Текст]` - **(ОНОВЛЕНО)** Надіслати повідомлення 1 користувачу.
 `/send_segment [Список ID/Тел.] [Текст]` - Надіслати повідомлення групі.
+`/segment_count [Сегмент]` - Скільки людей у сегменті і скільки триватиме розсилка.
+`/broadcast [Сегмент]` - Розсилка лише сегменту (напр. `/broadcast tag:км_535 AND has_phone`).
 
 ---
 **🏷️ Керування Мітками (Тегами):** (Працює у відповідь на тікет)
@@ -1490,21 +4235,24 @@ async def handle_all_messages(message: Message, state: FSMContext):
         if message.text and message.text.startswith('/'):
             return 
             
+        # ❗ Спершу підтверджуємо користувачу (один виклик API), а вже потім сповіщаємо адмінів
+        await message.answer("✅ Ваше повідомлення отримано. Адміністратор незабаром відповість вам.")
+
         user_id = message.from_user.id
         user_name = message.from_user.full_name or message.from_user.username or "Невідомий користувач"
         
         # ❗❗❗ НОВИЙ КОД: ВИБІРКА І ФОРМАТУВАННЯ МІТОК ❗❗❗
         tags_info = ""
-        # global pool тут не потрібен, він вище
-        async with pool.acquire() as conn:
-            # Отримуємо phone_number 
-            phone_number = await conn.fetchval("SELECT phone_number FROM users WHERE user_id = $1", user_id)
-            # Отримуємо мітки
-            user_tags = await conn.fetchval("SELECT tags FROM users WHERE user_id = $1", user_id)
+        # ❗ Телефон і мітки — з одного профілю (кеш або один запит до БД)
+        profile = await get_user_profile(user_id) or {}
+        phone_number = profile.get('phone_number')
+        user_tags = profile.get('tags')
+        if profile and profile['status'] != 'active':
+            await mark_user_active(user_id)
             
-        if user_tags and user_tags.strip():
+        if user_tags:
             # Форматуємо теги для відображення
-            tags_list = [f"<code>#{tag.strip()}</code>" for tag in user_tags.split(',') if tag.strip()]
+            tags_list = [f"<code>#{escape_html(tag)}</code>" for tag in user_tags]
             tags_info = " ".join(tags_list)
             tags_info = f"\n\n🏷️ <b>МІТКИ:</b> {tags_info}" # Додаємо заголовок Мітки
         # ❗❗❗ КІНЕЦЬ НОВОГО КОДУ ❗❗❗
@@ -1515,7 +4263,7 @@ async def handle_all_messages(message: Message, state: FSMContext):
         safe_phone = escape_html(phone_display)
         
         # ❗ Створюємо тікет
-        message_content = message.text[:200] if message.text else f"[{message.content_type or 'медіа'}]"
+        message_content = describe_message_content(message)
         await log_support_ticket(user_id, user_name, message_content)
 
         caption = (
@@ -1527,14 +4275,11 @@ async def handle_all_messages(message: Message, state: FSMContext):
             f"--- Щоб відповісти, <b>натисніть 'Відповісти'</b> на це повідомлення. ---"
         )
 
-        for target_admin_id in ADMINS:
-            try:
-                await message.forward(target_admin_id) 
-                await bot.send_message(chat_id=target_admin_id, text=caption, parse_mode='HTML')
-            except Exception as e:
-                logging.error(f"Помилка при пересиланні адміністратору {target_admin_id}: {e}")
-
-        await message.answer("✅ Ваше повідомлення отримано. Адміністратор незабаром відповість вам.")
+        delivered = await notify_admins(message, caption)
+        try:
+            await save_admin_message_map(user_id, delivered)
+        except Exception as e:
+            logging.error(f"Не вдалося зберегти зв'язок повідомлень адмінів з користувачем {user_id}: {e}")
         return
 
     # 6. ІНШЕ: Ігноруємо
@@ -1588,9 +4333,221 @@ from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_applicati
 #    - WEB_SERVER_PORT
 
 
+# --- ПРИЙОМ АПДЕЙТІВ (обмежена черга перед диспетчером) ---
+
+# Типи апдейтів, які обробляються як звичайні; решту (редагування, зміни статусу чату тощо) можна відкинути першими
+INGEST_USER_UPDATE_TYPES = ('message', 'callback_query')
+INGEST_PRIORITY_NAMES = ('admin', 'user', 'low')
+
+
+def classify_update(raw: dict) -> int:
+    """Пріоритет апдейта: 0 — від адміна, 1 — повідомлення/кнопка користувача, 2 — інше."""
+    for update_type, payload in raw.items():
+        if isinstance(payload, dict) and 'from' in payload:
+            if payload['from'].get('id') in ADMINS:
+                return 0
+            return 1 if update_type in INGEST_USER_UPDATE_TYPES else 2
+    return 2
+
+
+class IngestQueue:
+    """
+    Вебхук лише кладе апдейт у чергу і одразу відповідає Telegram; обробляють його INGEST_WORKERS воркерів.
+    Черга обмежена (INGEST_QUEUE_SIZE) і має три рівні пріоритету: адміни обслуговуються першими.
+    Коли черга повна: апдейт нижчого рівня витісняється на користь вищого (shed), неважливі апдейти
+    відкидаються, а решта отримує 503 — Telegram доставить їх пізніше (deferred).
+    """
+
+    def __init__(self, maxsize: int, workers: int):
+        self.maxsize = maxsize
+        self.workers_count = workers
+        self._lanes = [collections.deque() for _ in INGEST_PRIORITY_NAMES]
+        self._items = asyncio.Semaphore(0)
+        self._workers = []
+        self._accepting = True
+        self.in_flight = 0  # апдейти, які воркери обробляють просто зараз
+
+    def depth(self, priority: Optional[int] = None) -> int:
+        if priority is not None:
+            return len(self._lanes[priority])
+        return sum(len(lane) for lane in self._lanes)
+
+    def put(self, raw: dict) -> str:
+        """Повертає 'queued', 'shed' (апдейт відкинуто) або 'deferred' (відповісти 503)."""
+        if not self._accepting:
+            metrics['ingest_deferred'] += 1
+            return 'deferred'
+        priority = classify_update(raw)
+        if self.depth() >= self.maxsize:
+            victim = next((lane for lane in reversed(self._lanes[priority + 1:]) if lane), None)
+            if victim is not None:
+                # Місце звільняє найстаріший апдейт нижчого пріоритету; кількість у семафорі не змінюється
+                victim.popleft()
+                self._lanes[priority].append(raw)
+                metrics['ingest_shed'] += 1
+                metrics['ingest_queued'] += 1
+                return 'queued'
+            if priority == len(self._lanes) - 1:
+                metrics['ingest_shed'] += 1
+                return 'shed'
+            metrics['ingest_deferred'] += 1
+            return 'deferred'
+        self._lanes[priority].append(raw)
+        self._items.release()
+        metrics['ingest_queued'] += 1
+        return 'queued'
+
+    async def _get(self) -> dict:
+        await self._items.acquire()
+        for lane in self._lanes:
+            if lane:
+                return lane.popleft()
+
+    async def _worker(self):
+        while True:
+            raw = await self._get()
+            self.in_flight += 1
+            try:
+                update = Update.model_validate(raw, context={"bot": bot})
+                result = await dp.feed_update(bot, update)
+                if isinstance(result, TelegramMethod):
+                    await dp.silent_call_request(bot, result)
+            except Exception as e:
+                logging.error(f"Помилка обробки апдейта {raw.get('update_id')}: {type(e).__name__} - {e}")
+            finally:
+                self.in_flight -= 1
+
+    def start(self):
+        self._accepting = True
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.workers_count)]
+
+    async def shutdown(self, timeout: float):
+        """
+        Перестає приймати нові апдейти, дає воркерам дообробити чергу й апдейти, що вже в роботі, потім зупиняє їх.
+        Telegram уже отримав 200 на ці апдейти (і вони записані в processed_updates), тож перерваний — втрачений.
+        """
+        self._accepting = False
+        deadline = time.monotonic() + timeout
+        while (self.depth() or self.in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.depth() or self.in_flight:
+            logging.warning(
+                f"Зупинка: {self.depth()} апдейтів у черзі і {self.in_flight} в обробці не встигли завершитись."
+            )
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+
+
+ingest_queue = IngestQueue(INGEST_QUEUE_SIZE, INGEST_WORKERS)
+metric_gauges['ingest_queue_depth'] = ingest_queue.depth
+metric_gauges['ingest_in_flight'] = lambda: ingest_queue.in_flight
+for _priority, _name in enumerate(INGEST_PRIORITY_NAMES):
+    metric_gauges[f'ingest_queue_depth_{_name}'] = lambda p=_priority: ingest_queue.depth(p)
+
+
+async def handle_webhook_update(request: web.Request) -> web.Response:
+    """Вебхук Telegram: апдейт у чергу і одразу 200 (або 503, якщо черга переповнена)."""
+    try:
+        raw = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    if ingest_queue.put(raw) == 'deferred':
+        return web.Response(status=503, headers={'Retry-After': '5'})
+    return web.Response()
+
+
+# --- КІЛЬКА ВОРКЕРІВ (спільний порт, спільний стан у Postgres) ---
+
+INIT_DB_LOCK_ID = 724_001  # ключ advisory lock для міграцій при старті
+
+metric_gauges['worker_index'] = lambda: WORKER_INDEX
+
+async def run_worker_maintenance():
+    """
+    Періодично підхоплює розсилки загиблих воркерів; воркер 0 також чистить застарілі стани FSM,
+    admin_message_map і processed_updates (інакше між деплоями вони ростуть без обмежень).
+    """
+    while True:
+        await asyncio.sleep(BROADCAST_LEASE_SECONDS)
+        try:
+            await resume_unfinished_broadcasts()
+            if WORKER_INDEX == 0:
+                if isinstance(storage, PostgresStorage):
+                    removed = await storage.prune()
+                    if removed:
+                        logging.info(f"🧹 Видалено {removed} застарілих станів FSM.")
+                removed = await prune_retained_tables()
+                if removed:
+                    logging.info(f"🧹 Видалено {removed} застарілих записів admin_message_map / processed_updates.")
+        except Exception as e:
+            logging.error(f"Помилка періодичного обслуговування воркера: {e}")
+
+def run_worker(index: int, respawned: bool):
+    """Точка входу дочірнього процесу супервізора."""
+    global WORKER_INDEX, WORKER_RESPAWNED
+    WORKER_INDEX, WORKER_RESPAWNED = index, respawned
+    logging.info(f"Воркер {index} запускається (pid {os.getpid()}).")
+    try:
+        asyncio.run(start_bot_runner())
+    except (KeyboardInterrupt, SystemExit, asyncio.CancelledError):
+        logging.info(f"Воркер {index} зупинено.")
+    except Exception as e:
+        logging.critical(f"ПОМИЛКА ЗАПУСКУ воркера {index}: {e}")
+        raise SystemExit(1)
+
+def run_supervisor(workers: int):
+    """
+    Пре-форк супервізор: тримає `workers` процесів бота на одному порту (SO_REUSEPORT),
+    перезапускає загиблі, а по SIGTERM/SIGINT зупиняє всі і чекає їхнього коректного завершення.
+    """
+    context = multiprocessing.get_context("fork")
+    processes = {}
+    started_at = {}
+    stopping = False
+
+    def spawn(index: int, respawned: bool):
+        process = context.Process(target=run_worker, args=(index, respawned), name=f"bot-worker-{index}")
+        process.start()
+        processes[index] = process
+        started_at[index] = time.monotonic()
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for index in range(workers):
+        spawn(index, respawned=False)
+    logging.info(f"======== Супервізор запустив {workers} воркерів ========")
+
+    while not stopping:
+        time.sleep(1)
+        for index, process in list(processes.items()):
+            # Воркер, що впав одразу після старту (напр. БД недоступна), перезапускаємо не частіше ніж раз на 10 с
+            if stopping or process.is_alive() or time.monotonic() - started_at[index] < 10:
+                continue
+            logging.error(f"Воркер {index} (pid {process.pid}) завершився з кодом {process.exitcode}, перезапускаю.")
+            spawn(index, respawned=True)
+
+    for process in processes.values():
+        if process.is_alive():
+            process.terminate()
+    deadline = time.monotonic() + INGEST_SHUTDOWN_TIMEOUT + BACKGROUND_SHUTDOWN_TIMEOUT + 10
+    for process in processes.values():
+        process.join(max(0.0, deadline - time.monotonic()))
+        if process.is_alive():
+            logging.error(f"Воркер {process.name} не зупинився вчасно, завершую примусово.")
+            process.kill()
+    logging.info("Супервізор зупинено.")
+
+
 async def on_startup(app: web.Application):
     """Виконується ПІД ЧАС запуску aiohttp."""
     global pool # Отримуємо доступ до глобального 'pool'
+    global task_executor
     
     logging.info("Початок процедури on_startup...")
     
@@ -1602,21 +4559,39 @@ async def on_startup(app: web.Application):
         logging.critical("❌ WEBHOOK_URL не знайдено! Переконайтесь, що RENDER_EXTERNAL_URL є в .env")
         raise RuntimeError("WEBHOOK_URL not set")
         
-    # 2. Створюємо пул БД
+    # 2. Фонові задачі належать додатку і зупиняються разом з ним
+    task_executor = TaskExecutor(BACKGROUND_MAX_RUNNING, BACKGROUND_MAX_QUEUED)
+    app['task_executor'] = task_executor
+
+    # 3. Створюємо пул БД
     try:
         pool = await asyncpg.create_pool(DATABASE_URL)
-        # ❗ Ініціалізуємо БД ТУТ, ПІСЛЯ створення пулу
-        await init_db()
-        await populate_folders_if_empty()
+        # ❗ Ініціалізуємо БД ТУТ, ПІСЛЯ створення пулу.
+        #    Воркери стартують одночасно, тож міграції виконуються по черзі під advisory lock.
+        async with pool.acquire() as lock_conn:
+            await lock_conn.execute("SELECT pg_advisory_lock($1)", INIT_DB_LOCK_ID)
+            try:
+                await init_db()
+                await populate_folders_if_empty()
+            finally:
+                await lock_conn.execute("SELECT pg_advisory_unlock($1)", INIT_DB_LOCK_ID)
         logging.info("✅ Пул бази даних створено та ініціалізовано.")
+        await cache_bus.start()
+        # ❗ Продовжуємо розсилки, перервані рестартом; далі — періодично, на випадок загибелі іншого воркера
+        await resume_unfinished_broadcasts()
+        app['maintenance_task'] = asyncio.create_task(run_worker_maintenance())
+        # ❗ Воркери черги апдейтів стартують лише коли БД готова
+        ingest_queue.start()
     except Exception as e:
         logging.critical(f"❌ Помилка підключення/ініціалізації БД: {e}")
         raise # Зупиняємо запуск, якщо БД не працює
         
-    # 3. Встановлюємо вебхук
+    # 4. Встановлюємо вебхук (лише воркер 0; після його перезапуску черга апдейтів у Telegram не скидається)
+    if WORKER_INDEX != 0:
+        return
     try:
         # ❗ Використовуємо глобальну змінну WEBHOOK_URL (яка має брати RENDER_EXTERNAL_URL)
-        await bot.set_webhook(WEBHOOK_URL, drop_pending_updates=True)
+        await bot.set_webhook(WEBHOOK_URL, drop_pending_updates=not WORKER_RESPAWNED)
         logging.info(f"📡 Вебхук встановлено: {WEBHOOK_URL}")
     except Exception as e:
         logging.error(f"❌ Помилка встановлення вебхука: {e}")
@@ -1628,18 +4603,39 @@ async def on_shutdown(app: web.Application):
     
     logging.info("Початок процедури on_shutdown...")
     
-    # 1. Видаляємо вебхук
-    try:
-        await bot.delete_webhook()
-        logging.info("🧹 Вебхук видалено")
-    except Exception as e:
-        logging.error(f"Помилка видалення вебхука: {e}")
+    maintenance_task = app.get('maintenance_task')
+    if maintenance_task:
+        maintenance_task.cancel()
+        await asyncio.gather(maintenance_task, return_exceptions=True)
+
+    # 0. Дообробляємо апдейти, які вже прийняли від Telegram (нові отримують 503 і прийдуть повторно)
+    await ingest_queue.shutdown(INGEST_SHUTDOWN_TIMEOUT)
+
+    # 0.1. Даємо фоновим задачам завершитись (поки ще відкриті пул БД і сесія бота).
+    #    Незавершені розсилки залишаються 'running' і продовжаться після рестарту.
+    executor = app.get('task_executor')
+    if executor:
+        await executor.shutdown(BACKGROUND_SHUTDOWN_TIMEOUT)
+        logging.info("🧹 Фонові задачі зупинено")
+
+    # Пачки повідомлень, затримані антифлудом, відправляємо одразу, щоб не загубити їх при рестарті
+    await flood_middleware.flush_all()
+    
+    # 1. Видаляємо вебхук (з кількома воркерами — ні: решта продовжує приймати апдейти)
+    if WEB_CONCURRENCY == 1:
+        try:
+            await bot.delete_webhook()
+            logging.info("🧹 Вебхук видалено")
+        except Exception as e:
+            logging.error(f"Помилка видалення вебхука: {e}")
         
     # 2. Закриваємо сесію бота
+    await outbound_scheduler.close()
     await bot.session.close()
     logging.info("🧹 Сесію бота закрито")
     
-    # 3. Закриваємо пул БД
+    # 3. Закриваємо пул БД (спершу звільняємо з'єднання LISTEN)
+    await cache_bus.stop()
     if pool:
         try:
             await pool.close()
@@ -1651,6 +4647,12 @@ async def handle_root(request: web.Request) -> web.Response:
     """Для перевірок 'health check' від Render."""
     return web.Response(text="✅ EVA HRK бот активний і працює!", content_type='text/plain')
 
+async def handle_metrics(request: web.Request) -> web.Response:
+    """Лічильники бота в текстовому форматі (назва значення) для моніторингу."""
+    if METRICS_TOKEN and request.query.get('token') != METRICS_TOKEN:
+        raise web.HTTPForbidden()
+    return web.Response(text=render_metrics(), content_type='text/plain')
+
 # [ ВАШІ ФУНКЦІЇ on_startup, on_shutdown, handle_root ЗАЛИШАЮТЬСЯ ТУТ БЕЗ ЗМІН ]
 
 # ❗ ЗАМІНІТЬ ВАШУ 'async def main()' НА ЦЮ (З ВИПРАВЛЕНИМИ ВІДСТУПАМИ)
@@ -1667,6 +4669,12 @@ async def start_bot_runner():
     if not BOT_TOKEN:
         logging.critical("❌ Не знайдено BOT_TOKEN. Запуск неможливий.")
         return
+
+    # SIGTERM (Render, супервізор) скасовує основний цикл — далі спрацьовує on_shutdown
+    loop = asyncio.get_running_loop()
+    main_task = asyncio.current_task()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, main_task.cancel)
             
     # 1. Створюємо AIOHTTP-додаток
     app = web.Application()
@@ -1677,14 +4685,22 @@ async def start_bot_runner():
 
     # 3. Root route для перевірки
     app.router.add_get("/", handle_root)
+    app.router.add_get("/metrics", handle_metrics)
     
     # 4. Реєстрація вебхука (НОВИЙ, ЧИСТИЙ МЕТОД)
-    webhook_handler = SimpleRequestHandler(dispatcher=dp, bot=bot)
-    webhook_handler.register(app, path=WEBHOOK_PATH)
+    # З WEBHOOK_REPLY_MODE апдейт обробляється в межах запиту, щоб повернутий хендлером метод пішов у відповідь.
+    # Інакше — обмежена черга з пріоритетами: Telegram отримує 200 одразу, обробляють воркери.
+    if WEBHOOK_REPLY_MODE:
+        webhook_handler = SimpleRequestHandler(dispatcher=dp, bot=bot, handle_in_background=False)
+        webhook_handler.register(app, path=WEBHOOK_PATH)
+    else:
+        app.router.add_post(WEBHOOK_PATH, handle_webhook_update)
 
     # *** МИ ВИДАЛИЛИ setup_application, бо він конфліктує з AppRunner ***
     
-    logging.info(f"Хендлер вебхука зареєстровано (SimpleRequestHandler) на шляху: {WEBHOOK_PATH}")
+    logging.info(
+        f"Хендлер вебхука зареєстровано ({'SimpleRequestHandler' if WEBHOOK_REPLY_MODE else 'черга апдейтів'}) на шляху: {WEBHOOK_PATH}"
+    )
 
 
     # 5. НОВА ЛОГІКА ЗАПУСКУ (ФІКС 1-ХВИЛИНА):
@@ -1692,7 +4708,7 @@ async def start_bot_runner():
     runner = web.AppRunner(app)
     await runner.setup()
     
-    site = web.TCPSite(runner, host=WEB_SERVER_HOST, port=WEB_SERVER_PORT)
+    site = web.TCPSite(runner, host=WEB_SERVER_HOST, port=WEB_SERVER_PORT, reuse_port=WEB_CONCURRENCY > 1)
     await site.start()
     
     logging.info(f"======== 🚀 Сервер запущено (AppRunner/Webhooks) на http://{WEB_SERVER_HOST}:{WEB_SERVER_PORT} ========")
@@ -1712,10 +4728,18 @@ async def start_bot_runner():
 
 
 if __name__ == "__main__":
-    try:
-        # ❗ Викликаємо АСИНХРОННУ функцію
-        asyncio.run(start_bot_runner())
-    except (KeyboardInterrupt, SystemExit):
-        logging.info("Бот зупинено.")
-    except Exception as e:
-        logging.critical(f"ПОМИЛКА ЗАПУСКУ: {e}")
\ No newline at end of file
+    if WEB_CONCURRENCY > 1 and FSM_STORAGE == "memory":
+        # Стан діалогу жив би в одному воркері, а наступне оновлення того ж адміна може потрапити в інший
+        logging.critical("❌ FSM_STORAGE=memory несумісне з WEB_CONCURRENCY > 1. Використайте FSM_STORAGE=postgres.")
+        raise SystemExit(1)
+    if WEB_CONCURRENCY > 1 and BOT_TOKEN:
+        # ❗ Кілька процесів на одному порту; кожен виконує start_bot_runner()
+        run_supervisor(WEB_CONCURRENCY)
+    else:
+        try:
+            # ❗ Викликаємо АСИНХРОННУ функцію
+            asyncio.run(start_bot_runner())
+        except (KeyboardInterrupt, SystemExit, asyncio.CancelledError):
+            logging.info("Бот зупинено.")
+        except Exception as e:
+            logging.critical(f"ПОМИЛКА ЗАПУСКУ: {e}")